@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import logging
+import argparse
+import subprocess
+import tracemalloc
+
+from datetime import datetime
+
+import parsers
+
+from drhorton import DRHortonScraper
+from pulte import PulteScraper
+from sheahomes import SheaHomesScraper
+from ryanhomes import RyanHomesScraper
+from lennar import LennarScraper
+
+#########################################################################
+# Offline benchmarks for each extractor. Every benchmark runs on a fixture
+# in fixtures/ so nothing touches the network. Results are appended to
+# bench_results.jsonl along with the commit they were run on so that runs
+# can be compared over time:
+#
+#   $ python bench.py
+#   $ python bench.py --backend html.parser drhorton pulte
+#########################################################################
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name)) as fp:
+        if name.endswith('.json'):
+            return json.load(fp)
+        return fp.read()
+
+# Each benchmark returns the number of records one call produces and the
+# function to time
+
+def bench_drhorton_home_attrs():
+    scraper = DRHortonScraper()
+    jdat = load_fixture('drhorton_getrelated.json')
+    return len(jdat['HtmlItems']), lambda: scraper.scrape_html_items(jdat)
+
+def bench_pulte_listings():
+    scraper = PulteScraper()
+    html = load_fixture('pulte_search.html')
+    return len(scraper.parse_listings(html)), lambda: scraper.parse_listings(html)
+
+def bench_sheahomes_lot():
+    scraper = SheaHomesScraper()
+    html = load_fixture('sheahomes_lot.html')
+    return 1, lambda: scraper.parse_lot(html)
+
+def bench_sheahomes_delta():
+    scraper = SheaHomesScraper()
+    delta = load_fixture('sheahomes_delta.txt')
+    panel_id = 'p_lt_ctl03_pageplaceholder_p_lt_ctl05_QMIHomes_CMSUpdatePanel1'
+
+    def run():
+        soup = parsers.make_soup(scraper.get_update_panel(delta, panel_id))
+        return soup.select('section#qmi-homes div.card-content')
+
+    return len(run()), run
+
+def bench_ryanhomes_home_attrs():
+    scraper = RyanHomesScraper()
+    data = load_fixture('ryanhomes_search.json')
+
+    def run():
+        return [
+            scraper.scrape_home_attrs(data['options'], item) for item in data['items']
+        ]
+
+    return len(data['items']), run
+
+def bench_ryanhomes_listing_url():
+    scraper = RyanHomesScraper()
+    data = load_fixture('ryanhomes_search.json')
+
+    def run():
+        return [
+            scraper.gen_listing_url(data['options'], item) for item in data['items']
+        ]
+
+    return len(data['items']), run
+
+def bench_lennar_inventory():
+    scraper = LennarScraper()
+    data = load_fixture('lennar_inventory.json')
+
+    def run():
+        return [scraper.scrape_home_attrs(d) for d in data['ir']]
+
+    return len(data['ir']), run
+
+BENCHMARKS = {
+    'drhorton.scrape_home_attrs': bench_drhorton_home_attrs,
+    'pulte.parse_listings': bench_pulte_listings,
+    'sheahomes.scrape_lot': bench_sheahomes_lot,
+    'sheahomes.get_update_panel': bench_sheahomes_delta,
+    'ryanhomes.scrape_home_attrs': bench_ryanhomes_home_attrs,
+    'ryanhomes.gen_listing_url': bench_ryanhomes_listing_url,
+    'lennar.scrape_home_attrs': bench_lennar_inventory,
+}
+
+def run_benchmark(name, min_time=1.0):
+    '''
+    Time the benchmark for at least min_time seconds and measure the
+    peak memory allocated by one call
+    '''
+    records, func = BENCHMARKS[name]()
+    func() # warm up
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+
+    return {
+        'benchmark': name,
+        'records_per_sec': round(records * calls / elapsed, 1),
+        'ms_per_call': round(elapsed / calls * 1000, 3),
+        'peak_kb': round(peak / 1024, 1)
+    }
+
+def get_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                             capture_output=True, text=True, cwd=FIXTURES)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+def load_results(path):
+    '''
+    Return the last result saved for each benchmark and backend
+    '''
+    last = {}
+
+    if os.path.exists(path):
+        with open(path) as fp:
+            for line in fp:
+                r = json.loads(line)
+                last[(r['benchmark'], r['backend'])] = r
+
+    return last
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmarks', nargs='*',
+                        help='benchmarks to run (default: all), matched by prefix')
+    parser.add_argument('--backend', choices=parsers.available_backends(),
+                        help='HTML parser backend')
+    parser.add_argument('--min-time', type=float, default=1.0,
+                        help='seconds to run each benchmark for')
+    parser.add_argument('--results', default='bench_results.jsonl',
+                        help='file results are appended to')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    if args.backend:
+        parsers.set_backend(args.backend)
+
+    names = [
+        n for n in BENCHMARKS
+        if not args.benchmarks or any(n.startswith(b) for b in args.benchmarks)
+    ]
+
+    previous = load_results(args.results)
+    commit = get_commit()
+    timestamp = datetime.now().isoformat(timespec='seconds')
+
+    print(f"{'benchmark':30} {'records/s':>12} {'ms/call':>10} {'peak KB':>10} {'vs last':>8}")
+
+    with open(args.results, 'a') as fp:
+        for name in names:
+            result = run_benchmark(name, args.min_time)
+            result.update({
+                'backend': parsers.get_backend(),
+                'commit': commit,
+                'timestamp': timestamp
+            })
+            fp.write(json.dumps(result) + '\n')
+
+            change = ''
+            prev = previous.get((name, result['backend']))
+            if prev:
+                change = f"{result['records_per_sec'] / prev['records_per_sec'] - 1:+.0%}"
+
+            print(f"{name:30} {result['records_per_sec']:>12,.1f} {result['ms_per_call']:>10.3f} "
+                  f"{result['peak_kb']:>10.1f} {change:>8}")
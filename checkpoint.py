@@ -0,0 +1,105 @@
+import os
+import json
+import threading
+
+def checkpoint_path(output, builder):
+    '''
+    Return the checkpoint file for a scraper writing to output. Builders
+    sharing an inventory database each get their own.
+    '''
+    if output.endswith('.db'):
+        return f'{output}.{builder}.checkpoint'
+    return output + '.checkpoint'
+
+class Checkpoint(object):
+    """ Durable log of a scrape's progress so that an interrupted run can
+        be resumed without refetching finished work.
+
+        The log is a JSON Lines file. Work lists (community IDs, states,
+        URLs, ...) are written once they're discovered and every unit of
+        work is logged as it completes. Each entry is fsync'd before the
+        call returns. Callers should only mark a unit done once its output
+        is flushed, e.g. with Sink.after_flush(), so that resuming never
+        loses records.
+
+        Initialization components:
+            path (str): checkpoint file
+            resume (bool): load the progress logged by the last run instead
+                of starting over
+    """
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.work = {}
+        self.done = {}
+        self.lock = threading.Lock()
+
+        if resume and os.path.exists(path):
+            self.load()
+        self.fp = open(path, 'a' if resume else 'w')
+
+    def load(self):
+        size = 0
+
+        with open(self.path, 'rb') as fp:
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    break # last entry was only partially written
+
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+
+                size += len(line)
+                name = entry['name']
+
+                if entry['op'] == 'work':
+                    self.work[name] = entry['items']
+                elif entry['op'] == 'add':
+                    self.work.setdefault(name, []).extend(entry['items'])
+                elif entry['op'] == 'done':
+                    self.done.setdefault(name, set()).add(json.dumps(entry['unit']))
+
+        os.truncate(self.path, size)
+
+    def log(self, entry):
+        with self.lock:
+            self.fp.write(json.dumps(entry) + '\n')
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+
+    def get_work(self, name, discover):
+        '''
+        Return the work list name, calling discover to build it if it
+        wasn't logged by the last run
+        '''
+        if name not in self.work:
+            self.work[name] = list(discover())
+            self.log({'op': 'work', 'name': name, 'items': self.work[name]})
+
+        return self.work[name]
+
+    def add_work(self, name, items):
+        items = list(items)
+        with self.lock:
+            self.work.setdefault(name, []).extend(items)
+        self.log({'op': 'add', 'name': name, 'items': items})
+
+    def is_done(self, name, unit):
+        return json.dumps(unit) in self.done.get(name, ())
+
+    def mark_done(self, name, unit):
+        with self.lock:
+            self.done.setdefault(name, set()).add(json.dumps(unit))
+        self.log({'op': 'done', 'name': name, 'unit': unit})
+
+    def pending(self, name, items):
+        return [i for i in items if not self.is_done(name, i)]
+
+    def close(self, finished=False):
+        '''
+        Close the log, deleting it if the scrape finished
+        '''
+        self.fp.close()
+        if finished:
+            os.remove(self.path)
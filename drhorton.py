@@ -1,18 +1,51 @@
+import os
 import re
-import csv
 import json
-import time
+import math
+import hashlib
+import argparse
+import asyncio
 import logging
-import requests
 
 from redis import StrictRedis
 from redis.exceptions import RedisError
-from rediscache import RedisCache
+from rediscache import RedisCache, get_connection_pool
+from sqlitecache import SqliteCache
+from sinks import make_sink
+from records import Home, json_default
+from checkpoint import Checkpoint, checkpoint_path
+from transport import make_session
 from urllib.parse import urljoin
-from bs4 import BeautifulSoup
+from parsers import make_soup
+from metrics import timed, export_metrics
+from tracing import span, in_context, format_tree, profiling
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 class DRHortonScraper(object):
+    builder = 'drhorton'
+
+    fields = [
+        ('URL', 'url'),
+        ('Address', 'address'),
+        ('Sqft', 'sqft'),
+        ('Price', 'price'),
+        ('Stories', 'story'),
+        ('Beds', 'bed'),
+        ('Baths', 'bath'),
+        ('Garage', 'car')
+    ]
+
     radius = 500 
+    max_results = 1000 # most results Coveo will return for a query
+
+    # (south, west, north, east) box around every state in states
+    bounds = (18.0, -161.0, 50.0, -66.0)
+    min_tile_size = 0.01 # degrees
+
+    lat_field = 'fcoordinatesz32xlatitude33386'
+    lng_field = 'fcoordinatesz32xlongitude33386'
+
     states = [
         {
             "name": "hawaii",
@@ -256,9 +289,18 @@ class DRHortonScraper(object):
         }
     ]
 
-    def __init__(self):
-        self.url = 'https://www.drhorton.com'
-        self.session = requests.Session()
+    def __init__(self, concurrency=8, discovery='tiles', incremental=False,
+                 snapshot_path='DRHorton.snapshot.json', output='DRHorton.csv', resume=False,
+                 base_url='https://www.drhorton.com'):
+        self.url = base_url
+        self.output = output
+        self.resume = resume # continue from the checkpoint of an interrupted run
+        self.checkpoint = None
+        self.discovery = discovery # 'tiles' or 'states'
+        self.incremental = incremental # only paginate communities that changed
+        self.snapshot_path = snapshot_path
+        self.concurrency = concurrency # max in-flight requests to drhorton.com
+        self.session = make_session(pool_size=concurrency)
         self.headers = {
             'X-Requested-With': 'XMLHttpRequest'
         }
@@ -270,6 +312,7 @@ class DRHortonScraper(object):
         self.logger.setLevel(logging.DEBUG)
 
         self.cache = None
+        self.cache_batch_size = 500 # communities written to the cache at once
         #self.init_cache()
 
     def init_cache(self):
@@ -280,43 +323,28 @@ class DRHortonScraper(object):
             'password': 'foobared'
         }
 
-        client = StrictRedis(**redis_config)
+        client = StrictRedis(connection_pool=get_connection_pool(**redis_config))
         try:
             client.ping()
         except RedisError as ex:
-            exit(f'Failed to connect to Redis - {ex}, exiting...' )
+            self.logger.warning(f'Failed to connect to Redis - {ex}, using DRHorton.db')
+            self.cache = SqliteCache(path='DRHorton.db', compress=True)
+            return
 
         self.cache = RedisCache(client=client)
 
-    def csv_save(self, data):
-        headers = [
-            'URL',            
-            'Address',
-            'Sqft',
-            'Price',
-            'Stories',
-            'Beds',
-            'Baths',
-            'Garage'
-        ]
-
-        with open('DRHorton.csv', 'w') as fp:
-            writer = csv.writer(fp, quoting=csv.QUOTE_NONNUMERIC)
-            writer.writerow(headers)
-
-            for d in data:
-                row = [
-                    d.get('url', ''),                    
-                    d.get('address', ''),
-                    d.get('sqft', ''),
-                    d.get('price', ''),
-                    d.get('story', ''),
-                    d.get('bed', ''),
-                    d.get('bath', ''),
-                    d.get('car', '')
-                ]
-                row = [ i for i in row  ]
-                writer.writerow(row)
+    # Spec labels under each listing -> Home field
+    spec_fields = {
+        'story': 'story',
+        'stories': 'story',
+        'bed': 'bed',
+        'beds': 'bed',
+        'bath': 'bath',
+        'baths': 'bath',
+        'car': 'car',
+        'cars': 'car',
+        'garage': 'car'
+    }
 
     def scrape_home_attrs(self, home_info_div):
         h = home_info_div
@@ -341,9 +369,12 @@ class DRHortonScraper(object):
             
         for li in h.select('ul.specs > li'):
             k = li.contents[-1].strip().lower()
-            home[k] = li.strong.text.strip()
+            if k in self.spec_fields:
+                home[self.spec_fields[k]] = li.strong.text.strip()
+            else:
+                self.logger.debug(f'Skipping unknown spec {k} for {home["url"]}')
 
-        return home
+        return Home(**home)
     
     #########################################################################
     # They're using sitecore on the backend to do these queries in
@@ -366,7 +397,7 @@ class DRHortonScraper(object):
         skipped = []
         lat,lng = state['center'][0], state['center'][1]
         
-        url = 'https://www.drhorton.com/coveo/rest/v2'
+        url = urljoin(self.url, '/coveo/rest/v2')
         data = {
             'firstResult': 0,
             'numberOfResults': 1000,
@@ -380,16 +411,13 @@ class DRHortonScraper(object):
         }
 
         resp = self.session.post(url, data=data)
+        resp.raise_for_status()
         resp_data = resp.json()
 
         self.logger.info(f"Returning {len(resp_data['results'])} communities for {state}")
         
         for r in resp_data['results']:
-            k = next(
-                k for k in r['raw'].keys()
-                if k.startswith('fid')
-            )
-            v = r['raw'][k]
+            v = self.get_community_id(r)
 
             if v not in communities:
                 communities.append(v)
@@ -399,86 +427,480 @@ class DRHortonScraper(object):
 
         self.logger.info(f'Skipped {len(skipped)} duplicates')
         return communities
+
+    def get_community_id(self, result):
+        k = next(
+            k for k in result['raw'].keys()
+            if k.startswith('fid')
+        )
+        return result['raw'][k]
+
+    #########################################################################
+    # Instead of overlapping circles around each state's center we can split
+    # the map into non-overlapping tiles using a range query on the
+    # community coordinates. Each tile is first probed with
+    # numberOfResults=0 to read its totalCount. A tile with more than
+    # max_results communities would be truncated so it's split into four
+    # and each quarter is probed instead, and only tiles under the cap have
+    # their results fetched. Tiles are half-open so a community always falls
+    # into exactly one of them.
+    #########################################################################
+    def query_tile(self, tile, count):
+        '''
+        Return the search response for the first count communities in tile
+        '''
+        south, west, north, east = tile
+
+        url = urljoin(self.url, '/coveo/rest/v2')
+        data = {
+            'firstResult': 0,
+            'numberOfResults': count,
+            'aq': f'(@{self.lat_field}>={south}) (@{self.lat_field}<{north}) '
+                  f'(@{self.lng_field}>={west}) (@{self.lng_field}<{east})'
+        }
+
+        resp = self.session.post(url, data=data)
+        resp.raise_for_status()
+        return resp.json()
+
+    def get_tile_communities(self, tile, communities, stats):
+        '''
+        Add the communities in tile to communities, a dict mapping
+        community ID to (lat,lng)
+        '''
+        south, west, north, east = tile
+
+        total = self.query_tile(tile, 0)['totalCount']
+        stats['queries'] += 1
+
+        if total == 0:
+            return communities
+
+        truncated = total > self.max_results
+        splittable = max(north - south, east - west) > self.min_tile_size
+
+        if truncated and splittable:
+            self.logger.debug(f'Splitting tile {tile} with {total} communities')
+
+            lat = (south + north) / 2
+            lng = (west + east) / 2
+
+            for t in [(south, west, lat, lng), (south, lng, lat, east),
+                      (lat, west, north, lng), (lat, lng, north, east)]:
+                self.get_tile_communities(t, communities, stats)
+
+            return communities
+
+        results = self.query_tile(tile, self.max_results)['results']
+        stats['queries'] += 1
+
+        if truncated:
+            self.logger.warning(f'Tile {tile} truncated to {len(results)} of {total} communities')
+
+        for r in results:
+            v = self.get_community_id(r)
+
+            if v not in communities:
+                communities[v] = (
+                    r['raw'].get(self.lat_field),
+                    r['raw'].get(self.lng_field)
+                )
+            else:
+                stats['duplicates'] += 1
+
+        return communities
+
+    def estimate_state_stats(self, communities):
+        '''
+        Return the number of queries the per-state search would have taken
+        to return the communities found by tiling, and the duplicates it
+        would have returned and the communities it would have missed, with
+        each query truncated to max_results
+        '''
+        def distance(lat1, lng1, lat2, lng2):
+            # Haversine distance in the same units as the dist()/1610 query
+            lat1, lng1, lat2, lng2 = map(math.radians, [lat1, lng1, lat2, lng2])
+            a = math.sin((lat2 - lat1) / 2) ** 2 + \
+                math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+            return 2 * 6371000 * math.asin(math.sqrt(a)) / 1610
+
+        coords = [
+            (float(lat), float(lng)) for lat, lng in communities.values()
+            if lat is not None and lng is not None
+        ]
+
+        found = set()
+        returned = 0
+
+        for state in DRHortonScraper.states:
+            lat, lng = float(state['center'][0]), float(state['center'][1])
+            in_range = [
+                i for i, c in enumerate(coords)
+                if distance(lat, lng, c[0], c[1]) < self.radius
+            ]
+            in_range = in_range[:self.max_results]
+            returned += len(in_range)
+            found.update(in_range)
+
+        return {
+            'queries': len(DRHortonScraper.states),
+            'duplicates': returned - len(found),
+            'missed': len(coords) - len(found)
+        }
+
+    def get_communities(self):
+        '''
+        Return a list of community IDs for every state
+        '''
+        communities = []
+
+        if self.discovery == 'states':
+            for state in DRHortonScraper.states:
+                self.get_state_communities(state, communities)
+            return communities
+
+        stats = {'queries': 0, 'duplicates': 0}
+        tiled = self.get_tile_communities(self.bounds, {}, stats)
+        state_stats = self.estimate_state_stats(tiled)
+
+        self.logger.info(
+            f"Found {len(tiled)} communities with {stats['queries']} queries and "
+            f"{stats['duplicates']} duplicates, where the per-state search takes "
+            f"{state_stats['queries']} queries, returns {state_stats['duplicates']} duplicates "
+            f"and misses {state_stats['missed']} communities"
+        )
+
+        communities += tiled.keys()
+        return communities
     
-    def get_movein_ready(self, community_id):
+    def get_movein_ready_page(self, community_id, start_index, count=8):
         '''
-        Return the HTML for the Move In Ready homes using internal API
+        Return the JSON for one page of Move In Ready homes using internal API
         '''
-        homes = []
-        
-        # {EA8CC92D-EEEA-4CC5-8BD1-AD65388128F4} has more than 8 for testing
-        #community_id = '{EA8CC92D-EEEA-4CC5-8BD1-AD65388128F4}'
-        
-        url = 'https://www.drhorton.com/api/drh/moveinreadyapi/getrelated'
+        url = urljoin(self.url, '/api/drh/moveinreadyapi/getrelated')
         data = {
             'ItemId': community_id,
-            'StartIndex': 0,
-            'Count': 8
+            'StartIndex': start_index,
+            'Count': count
         }
 
-        self.logger.debug(f'Getting move in ready homes for {community_id}')
+        resp = self.session.post(url, data=data)
+        resp.raise_for_status()
+        return resp.json()
+
+    @span('parse')
+    @timed('drhorton.scrape_html_items')
+    def scrape_html_items(self, jdat):
+        homes = []
+
+        for item in jdat['HtmlItems']:
+            h = make_soup(item)
+            home = self.scrape_home_attrs(h)
+            homes.append(home)
 
+        return homes
+
+    def get_cached_homes(self, community_id):
         if self.cache:
             try:
                 cached_homes = self.cache[community_id]
             except KeyError:
                 pass
             else:
-                homes = json.loads(cached_homes)
+                homes = [Home.from_dict(d) for d in json.loads(cached_homes)]
                 self.logger.info(f'Returning {len(homes)} homes from cache')
                 return homes
 
-        while True:
-            time.sleep(5)
-            try:            
-                resp = self.session.post(url, data=data)
-                jdat = resp.json()
-            except requests.exceptions.ConnectionError as e:
-                self.logger.warning(f'Exception {e}')
-                time.sleep(60)
-                continue
-            except Exception as e:
-                self.logger.warning(f'Exception {e}')
-                homes = [] # reset homes
-                break
+        return None
+
+    def set_cached_homes(self, community_id, homes):
+        if self.cache and len(homes) > 0:
+            self.cache[community_id] = json.dumps(homes, default=json_default)
+
+    def get_cached_homes_many(self, community_ids):
+        '''
+        Return a dict mapping community ID to homes for every community
+        in community_ids that is in the cache
+        '''
+        if not self.cache:
+            return {}
+
+        cached = self.cache.get_many(community_ids)
+        self.logger.info(f'Returning {len(cached)} / {len(community_ids)} communities from cache')
+
+        return {
+            cid: [Home.from_dict(d) for d in json.loads(homes)] for cid, homes in cached.items()
+        }
 
-            for item in jdat['HtmlItems']:
-                h = BeautifulSoup(item, 'html.parser')
-                home = self.scrape_home_attrs(h)
-                homes.append(home)
+    def set_cached_homes_many(self, homes_by_community):
+        if self.cache:
+            self.cache.set_many({
+                cid: json.dumps(homes, default=json_default) for cid, homes in homes_by_community.items()
+                if len(homes) > 0
+            })
+
+    def get_movein_ready(self, community_id):
+        '''
+        Return the HTML for the Move In Ready homes using internal API.
+        Requests are retried by the session so an error here means the
+        homes couldn't be loaded and is raised.
+        '''
+        homes = []
+        
+        # {EA8CC92D-EEEA-4CC5-8BD1-AD65388128F4} has more than 8 for testing
+        #community_id = '{EA8CC92D-EEEA-4CC5-8BD1-AD65388128F4}'
+        
+        self.logger.debug(f'Getting move in ready homes for {community_id}')
+
+        cached_homes = self.get_cached_homes(community_id)
+        if cached_homes is not None:
+            return cached_homes
+
+        while True:
+            jdat = self.get_movein_ready_page(community_id, len(homes))
+            homes += self.scrape_html_items(jdat)
 
             self.logger.debug(f"Got {len(homes)} / {jdat['TotalItems']} homes")
             
             if len(homes) >= jdat['TotalItems'] or len(jdat['HtmlItems']) == 0:
                 break
-            
-            data['StartIndex'] = len(homes)
 
-        if self.cache and len(homes) > 0:
-            self.cache[community_id] = json.dumps(homes)
+        self.set_cached_homes(community_id, homes)
+        return homes
+
+    #########################################################################
+    # Asyncio engine for the Move In Ready crawl. The HTTP calls are still
+    # made through self.session but are run on a thread pool so that pages
+    # for many communities are in flight at once. A semaphore caps the
+    # number of concurrent requests to drhorton.com at self.concurrency.
+    #
+    # Once the first page of a community comes back we know TotalItems so
+    # the remaining pages are requested concurrently as well.
+    #
+    # A community whose pages can't be loaded, even after the session's
+    # retries, is left out of the checkpoint so --resume tries it again.
+    #########################################################################
+    async def fetch_movein_ready_page(self, semaphore, community_id, start_index, count=8):
+        loop = asyncio.get_running_loop()
+
+        async with semaphore:
+            return await loop.run_in_executor(
+                None, in_context(self.get_movein_ready_page), community_id, start_index, count
+            )
 
+    async def get_movein_ready_async(self, semaphore, community_id, page_size=8, first_page=None):
+        self.logger.debug(f'Getting move in ready homes for {community_id}')
+
+        jdat = first_page or await self.fetch_movein_ready_page(semaphore, community_id, 0)
+        homes = self.scrape_html_items(jdat)
+
+        if len(homes) < jdat['TotalItems'] and len(jdat['HtmlItems']) > 0:
+            pages = await asyncio.gather(*[
+                self.fetch_movein_ready_page(semaphore, community_id, i)
+                for i in range(len(homes), jdat['TotalItems'], page_size)
+            ])
+            for page in pages:
+                homes += self.scrape_html_items(page)
+
+        self.logger.debug(f"Got {len(homes)} / {jdat['TotalItems']} homes for {community_id}")
         return homes
+
+    #########################################################################
+    # Incremental crawl. Most communities don't change from one day to the
+    # next so we first ask for a single item to read TotalItems and compare
+    # it, along with a hash of the first item's HTML, against the snapshot
+    # saved by the last run. Only communities that differ are paginated and
+    # parsed; the rest reuse the homes from the snapshot.
+    #########################################################################
+    def load_snapshot(self):
+        try:
+            with open(self.snapshot_path) as fp:
+                snapshot = json.load(fp)
+        except FileNotFoundError:
+            return {}
+
+        for entry in snapshot.values():
+            entry['homes'] = [Home.from_dict(d) for d in entry['homes']]
+
+        return snapshot
+
+    def save_snapshot(self, snapshot):
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(snapshot, fp, default=json_default)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def get_signature(self, jdat):
+        items = jdat['HtmlItems']
+        if not items:
+            return None
+        return hashlib.sha1(items[0].encode('utf-8')).hexdigest()
+
+    async def get_movein_ready_incremental(self, semaphore, community_id, snapshot):
+        '''
+        Return the homes for community_id along with its new snapshot entry
+        '''
+        jdat = await self.fetch_movein_ready_page(semaphore, community_id, 0, count=1)
+
+        entry = {
+            'total': jdat['TotalItems'],
+            'signature': self.get_signature(jdat)
+        }
+
+        prev = snapshot.get(community_id)
+        if prev and prev['total'] == entry['total'] and prev['signature'] == entry['signature']:
+            self.logger.debug(f'{community_id} unchanged, returning {len(prev["homes"])} homes from snapshot')
+            return prev['homes'], prev
+
+        homes = await self.get_movein_ready_async(semaphore, community_id, first_page=jdat)
+        entry['homes'] = homes
+        return homes, entry
+
+    async def get_movein_ready_many_async(self, communities, sink):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        loop = asyncio.get_running_loop()
+        done = 0
+        changed = 0
+
+        # Resolve everything we can from the cache up front
+        cached = self.get_cached_homes_many(communities)
+        fetched = {}
+
+        snapshot = self.load_snapshot() if self.incremental else {}
+        new_snapshot = {}
+        failed = []
+
+        def set_fetched(cid, homes):
+            nonlocal changed
+            changed += 1
+            if self.cache:
+                fetched[cid] = homes
+
+                # Write as we go so memory doesn't grow with the crawl and
+                # a crash keeps what was fetched
+                if len(fetched) >= self.cache_batch_size:
+                    self.set_cached_homes_many(fetched)
+                    fetched.clear()
+
+        async def get_movein_ready(cid):
+            nonlocal done
+            if cid in cached:
+                homes = cached.pop(cid)
+                if cid in snapshot:
+                    new_snapshot[cid] = snapshot[cid]
+            else:
+                try:
+                    if self.incremental:
+                        homes, entry = await self.get_movein_ready_incremental(semaphore, cid, snapshot)
+                    else:
+                        homes = await self.get_movein_ready_async(semaphore, cid)
+                except Exception as e:
+                    self.logger.warning(f'Failed to get homes for {cid}: {e}')
+                    failed.append(cid)
+                    return
+
+                if self.incremental:
+                    new_snapshot[cid] = entry
+                    if entry is not snapshot.get(cid):
+                        set_fetched(cid, homes)
+                else:
+                    set_fetched(cid, homes)
+
+            sink.write_many(homes)
+
+            if self.checkpoint:
+                sink.after_flush(partial(self.checkpoint.mark_done, 'communities', cid))
+
+            done += 1
+            self.logger.info(f'{done}/{len(communities)}')
+
+        # asyncio.run() shuts the default executor down on exit
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=self.concurrency))
+
+        await asyncio.gather(*[
+            get_movein_ready(cid) for cid in communities
+        ])
+
+        self.set_cached_homes_many(fetched)
+
+        if self.incremental:
+            self.logger.info(f'{changed} / {len(communities)} communities changed since the last run')
+
+            if self.resume:
+                # Keep the entries for communities finished before we resumed
+                pending = set(communities)
+                for cid, entry in snapshot.items():
+                    if cid not in pending:
+                        new_snapshot.setdefault(cid, entry)
+
+            self.save_snapshot(new_snapshot)
+
+        return failed
+
+    def get_movein_ready_many(self, communities, sink):
+        '''
+        Write the Move In Ready homes for all communities to sink as each
+        community completes, fetching up to self.concurrency pages at a time.
+        The communities whose homes couldn't be loaded are returned.
+        '''
+        return asyncio.run(self.get_movein_ready_many_async(communities, sink))
     
+    #########################################################################
+    # Work units for a distributed crawl (see workqueue.py)
+    #########################################################################
+    def get_work_units(self):
+        return self.get_communities()
+
+    def process_work_unit(self, community_id):
+        '''
+        Return the homes for community_id and the new units found, of
+        which there are none
+        '''
+        return self.get_movein_ready(community_id), []
+
+    @span('drhorton.scrape')
     def scrape(self):
-        homes = []
-        communities = []
+        self.checkpoint = Checkpoint(checkpoint_path(self.output, self.builder), self.resume)
 
-        for state in DRHortonScraper.states:
-            self.get_state_communities(state, communities)
-            time.sleep(5)
+        with span('discovery'):
+            communities = self.checkpoint.get_work('communities', self.get_communities)
+        pending = self.checkpoint.pending('communities', communities)
 
-        self.logger.info(f'{len(communities)} communities')
-        
-        for i,cid in enumerate(communities, 1):
-            self.logger.info(f'{i}/{len(communities)}')
-            m = self.get_movein_ready(cid)
-            homes += m
+        self.logger.info(f'{len(pending)} / {len(communities)} communities left to scrape')
 
-        self.logger.info(f'Scraped {len(homes)} in total')
-        self.csv_save(homes)
+        with make_sink(self.output, self.fields, append=self.resume, builder=self.builder) as sink:
+            failed = self.get_movein_ready_many(pending, sink)
+            sink.close(finished=not failed)
 
-        return homes
+        # Keep the checkpoint so --resume can retry the failed communities
+        self.checkpoint.close(finished=not failed)
+
+        if failed:
+            self.logger.warning(f'Failed to get homes for {len(failed)} communities, run with --resume to retry them')
+
+        self.logger.info(f'Scraped {sink.count} in total')
+        return sink.count
     
 if __name__ == '__main__':
-    scraper = DRHortonScraper()
-    scraper.scrape()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--incremental', action='store_true',
+                        help='only paginate communities that changed since the last run')
+    parser.add_argument('--output', default='DRHorton.csv',
+                        help='output file (.csv or .jsonl, optionally .gz, .parquet, .arrow, or .db to add to an inventory database)')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from where the last run stopped')
+    parser.add_argument('--base-url', default='https://www.drhorton.com',
+                        help='site to scrape, e.g. a local mockserver.py')
+    parser.add_argument('--profile', choices=['cprofile', 'sample'],
+                        help='profile the run, saving the results next to the output')
+    args = parser.parse_args()
+
+    export_metrics()
+
+    scraper = DRHortonScraper(incremental=args.incremental, output=args.output, resume=args.resume,
+                              base_url=args.base_url)
+
+    with profiling(args.profile, args.output):
+        scraper.scrape()
+
+    scraper.logger.info('Time per stage:\n' + format_tree())
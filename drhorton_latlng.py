@@ -2,18 +2,17 @@ import os
 import re
 import csv
 import json
-import time
 import logging
-import requests
 
+from transport import make_session
 from urllib.parse import urljoin
-from bs4 import BeautifulSoup
+from parsers import make_soup
 
 # Script to gather the center (lat,lng) of each of the states listed
 class DRHortonScraper(object):
     def __init__(self):
         self.url = 'https://www.drhorton.com/no-results'
-        self.session = requests.Session()
+        self.session = make_session()
         self.headers = {
             'X-Requested-With': 'XMLHttpRequest'
         }
@@ -31,7 +30,7 @@ class DRHortonScraper(object):
         states = []
         
         resp = self.session.get(self.url)
-        soup = BeautifulSoup(resp.text, 'html.parser')
+        soup = make_soup(resp.text)
 
         g = soup.select_one('svg#us-map > g')
         for a in g.find_all('a', href=True):
@@ -49,7 +48,7 @@ class DRHortonScraper(object):
         their map div
         '''
         resp = self.session.get(state['url'])
-        soup = BeautifulSoup(resp.text, 'html.parser')
+        soup = make_soup(resp.text)
 
         d = soup.select_one('div.map > div.CoveoCommunityFinderMap')
         lat,lng = d['data-latitude'],d['data-longitude']
@@ -60,7 +59,6 @@ class DRHortonScraper(object):
         states = self.get_states()
         for state in states:
             self.get_state_center_latlng(state)
-            time.sleep(5)
         
         print(json.dumps(states, indent=2))
         
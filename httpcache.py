@@ -0,0 +1,151 @@
+import os
+import json
+import base64
+import threading
+import requests
+import metrics
+
+from datetime import timedelta
+from redis import StrictRedis
+from redis.exceptions import RedisError
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from rediscache import RedisCache
+from sqlitecache import SqliteCache
+
+# Headers that describe the body as it came over the wire rather than the
+# decoded body we store
+SKIP_HEADERS = ['Content-Encoding', 'Content-Length', 'Transfer-Encoding']
+
+class CachingAdapter(HTTPAdapter):
+    """ Transport adapter that stores GET responses which carry an ETag or
+        Last-Modified validator. The next request for the same URL is sent
+        with If-None-Match / If-Modified-Since and a 304 from the server is
+        answered with the stored body.
+
+        Initialization components:
+            cache: a mapping of URL to serialized response, such as a
+                RedisCache (if not set, get_http_cache() is used). If there
+                is no store responses pass through uncached.
+    """
+    def __init__(self, cache=None, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = get_http_cache() if cache is None else cache
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, url):
+        try:
+            return json.loads(self.cache[url])
+        except KeyError:
+            return None
+
+    def store(self, resp):
+        headers = {
+            k: v for k, v in resp.headers.items() if k not in SKIP_HEADERS
+        }
+
+        self.cache[resp.url] = json.dumps({
+            'status': resp.status_code,
+            'reason': resp.reason,
+            'headers': headers,
+            'content': base64.b64encode(resp.content).decode('ascii')
+        })
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET' or self.cache is None:
+            return super().send(request, **kwargs)
+
+        entry = self.load(request.url)
+        if entry:
+            headers = CaseInsensitiveDict(entry['headers'])
+            if 'ETag' in headers:
+                request.headers['If-None-Match'] = headers['ETag']
+            if 'Last-Modified' in headers:
+                request.headers['If-Modified-Since'] = headers['Last-Modified']
+
+        resp = super().send(request, **kwargs)
+
+        if resp.status_code == 304 and entry:
+            self.hits += 1
+            metrics.CACHE_REQUESTS.inc(cache='http_revalidation', result='hit')
+            return self.build_cached_response(request, entry, resp)
+
+        self.misses += 1
+        metrics.CACHE_REQUESTS.inc(cache='http_revalidation', result='miss')
+
+        if resp.status_code == 200 and ('ETag' in resp.headers or 'Last-Modified' in resp.headers):
+            self.store(resp)
+
+        return resp
+
+    def build_cached_response(self, request, entry, not_modified):
+        '''
+        Return a 200 response with the stored body for a 304 from the server
+        '''
+        resp = requests.Response()
+
+        resp.status_code = entry['status']
+        resp.reason = entry['reason']
+        resp.headers = CaseInsensitiveDict(entry['headers'])
+        resp.headers.update({
+            k: v for k, v in not_modified.headers.items() if k not in SKIP_HEADERS
+        })
+        resp._content = base64.b64decode(entry['content'])
+        resp.encoding = get_encoding_from_headers(resp.headers)
+
+        resp.url = request.url
+        resp.request = request
+        resp.raw = not_modified.raw
+        resp.elapsed = not_modified.elapsed
+        resp.connection = self
+        resp.from_cache = True
+
+        return resp
+
+def mount_http_cache(session, cache=None):
+    '''
+    Send every http:// and https:// request made by session through a
+    CachingAdapter
+    '''
+    adapter = CachingAdapter(cache)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+_cache = None
+_cache_loaded = False
+_cache_lock = threading.Lock()
+
+def get_http_cache():
+    '''
+    Return the response store shared by all scrapers in this process. If
+    HTTPCACHE_REDIS_URL is set responses are kept in Redis for 30 days so
+    they can be revalidated by later runs. Otherwise, if HTTPCACHE_PATH is
+    set, they are kept in a SQLite database at that path; it is ignored
+    when HTTPCACHE_REDIS_URL is set as well. Otherwise None is
+    returned and nothing is cached, since a run rarely fetches a page twice
+    and keeping every response in memory would only grow with the crawl.
+    '''
+    global _cache, _cache_loaded
+
+    with _cache_lock:
+        if not _cache_loaded:
+            _cache_loaded = True
+
+            url = os.environ.get('HTTPCACHE_REDIS_URL')
+            path = os.environ.get('HTTPCACHE_PATH')
+
+            if url:
+                client = StrictRedis.from_url(url)
+                try:
+                    client.ping()
+                except RedisError as ex:
+                    exit(f'Failed to connect to Redis - {ex}, exiting...' )
+
+                _cache = RedisCache(client=client, namespace='http', expires=timedelta(days=30))
+            elif path:
+                _cache = SqliteCache(path=path, compress=True, namespace='http', expires=timedelta(days=30))
+
+    return _cache
@@ -0,0 +1,205 @@
+import csv
+import sys
+import sqlite3
+import argparse
+
+from datetime import datetime, timedelta, timezone
+
+#########################################################################
+# Inventory of every home seen by any run in one SQLite database. Each run
+# upserts the homes it finds, keyed by builder and listing URL, so a home
+# keeps the time of the run that first saw it and is updated with the
+# time and run that last saw it. That answers questions like
+#
+#   $ python inventory.py inventory.db new --days 7      # listed this week
+#   $ python inventory.py inventory.db gone --days 7     # sold or pulled
+#
+# without diffing CSV files. Times are UTC in SQLite's datetime format so
+# they can be compared with datetime('now', '-7 days') in SQL.
+#########################################################################
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    builder TEXT NOT NULL,
+    started TEXT NOT NULL,
+    finished TEXT,
+    records INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS listings (
+    builder TEXT NOT NULL,
+    url TEXT NOT NULL,
+    address TEXT,
+    community TEXT,
+    community_url TEXT,
+    state TEXT,
+    price INTEGER,
+    sqft INTEGER,
+    bed INTEGER,
+    bath REAL,
+    car REAL,
+    story REAL,
+    first_seen TEXT NOT NULL,
+    last_seen TEXT NOT NULL,
+    first_run INTEGER NOT NULL,
+    last_run INTEGER NOT NULL,
+    PRIMARY KEY (builder, url)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS listings_community ON listings (community);
+CREATE INDEX IF NOT EXISTS listings_state_price ON listings (state, price);
+CREATE INDEX IF NOT EXISTS listings_price ON listings (price);
+CREATE INDEX IF NOT EXISTS listings_first_seen ON listings (first_seen);
+CREATE INDEX IF NOT EXISTS listings_builder_last_run ON listings (builder, last_run);
+'''
+
+# Columns set from each record, in the order they're inserted
+COLUMNS = ['url', 'address', 'community', 'community_url', 'state', 'price', 'sqft',
+           'bed', 'bath', 'car', 'story']
+
+# A field missing from a record, e.g. an address whose page failed to load,
+# keeps the value seen by an earlier run rather than being cleared
+UPSERT = f'''
+INSERT INTO listings (builder, {', '.join(COLUMNS)}, first_seen, last_seen, first_run, last_run)
+VALUES (?, {', '.join('?' for c in COLUMNS)}, ?, ?, ?, ?)
+ON CONFLICT (builder, url) DO UPDATE SET
+    {', '.join(f'{c} = COALESCE(excluded.{c}, listings.{c})' for c in COLUMNS[1:])},
+    last_seen = excluded.last_seen,
+    last_run = excluded.last_run
+'''
+
+def utcnow():
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+class Inventory(object):
+    """ SQLite database of the homes seen by every run.
+
+        Initialization components:
+            path (str): path of the SQLite database file
+    """
+    def __init__(self, path='inventory.db'):
+        self.path = path
+
+        # Sinks serialize their writes so the connection can be used from
+        # whichever thread is writing
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+
+        # Enough cache to keep the indexes in memory while a run upserts
+        self.conn.execute('PRAGMA cache_size=-65536')
+        self.conn.executescript(SCHEMA)
+
+    def start_run(self, builder, resume=False):
+        '''
+        Record the start of a run for builder and return its (id, start time).
+        If resume is set the last run of builder is carried on instead, as
+        long as it didn't finish.
+        '''
+        if resume:
+            row = self.conn.execute(
+                'SELECT id, started, finished FROM runs WHERE builder = ? ORDER BY id DESC LIMIT 1',
+                (builder,)
+            ).fetchone()
+
+            if row and row[2] is None:
+                return row[0], row[1]
+
+        started = utcnow()
+
+        with self.conn:
+            cur = self.conn.execute(
+                'INSERT INTO runs (builder, started) VALUES (?, ?)', (builder, started)
+            )
+
+        return cur.lastrowid, started
+
+    def finish_run(self, run_id):
+        '''
+        Mark run run_id finished, counting the homes it saw, including any
+        seen before it was resumed
+        '''
+        with self.conn:
+            self.conn.execute(
+                'UPDATE runs SET finished = ?, records = '
+                '(SELECT COUNT(*) FROM listings l WHERE l.builder = runs.builder AND l.last_run = runs.id) '
+                'WHERE id = ?',
+                (utcnow(), run_id)
+            )
+
+    def upsert_many(self, builder, run_id, seen, records):
+        '''
+        Insert or update records, seen by run run_id at time seen, in
+        one transaction
+        '''
+        rows = [
+            (builder, *[r.get(c) for c in COLUMNS], seen, seen, run_id, run_id)
+            for r in records
+        ]
+
+        with self.conn:
+            self.conn.executemany(UPSERT, rows)
+
+    def query(self, sql, params=()):
+        cur = self.conn.execute(sql, params)
+        return [d[0] for d in cur.description], cur.fetchall()
+
+    def new_listings(self, since, builder=None):
+        '''
+        Return the listings first seen since the UTC datetime string since
+        '''
+        return self.query(
+            'SELECT * FROM listings WHERE first_seen >= ? AND (? IS NULL OR builder = ?) '
+            'ORDER BY first_seen',
+            (since, builder, builder)
+        )
+
+    def gone_listings(self, since, builder=None):
+        '''
+        Return the listings last seen since the UTC datetime string since
+        that the latest finished run of their builder didn't see
+        '''
+        return self.query(
+            'SELECT l.* FROM listings l '
+            'JOIN (SELECT builder, MAX(id) AS id FROM runs WHERE finished IS NOT NULL GROUP BY builder) r '
+            'ON l.builder = r.builder '
+            'WHERE l.last_run < r.id AND l.last_seen >= ? AND (? IS NULL OR l.builder = ?) '
+            'ORDER BY l.last_seen',
+            (since, builder, builder)
+        )
+
+    def runs(self, builder=None):
+        return self.query(
+            'SELECT * FROM runs WHERE (? IS NULL OR builder = ?) ORDER BY id', (builder, builder)
+        )
+
+    def flush(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='inventory database')
+    parser.add_argument('report', choices=['new', 'gone', 'runs'],
+                        help='new: listings first seen in the period, gone: listings no longer '
+                             'listed that were last seen in the period, runs: every run')
+    parser.add_argument('--days', type=float, default=7,
+                        help='length of the period ending now (default: 7)')
+    parser.add_argument('--builder', help='only show this builder, e.g. pulte')
+    args = parser.parse_args()
+
+    inventory = Inventory(args.path)
+    since = (datetime.now(timezone.utc) - timedelta(days=args.days)).strftime('%Y-%m-%d %H:%M:%S')
+
+    if args.report == 'new':
+        columns, rows = inventory.new_listings(since, args.builder)
+    elif args.report == 'gone':
+        columns, rows = inventory.gone_listings(since, args.builder)
+    else:
+        columns, rows = inventory.runs(args.builder)
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(columns)
+    writer.writerows(rows)
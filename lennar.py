@@ -1,12 +1,27 @@
-import csv
 import json
-import requests
+import argparse
+from transport import make_session
+from sinks import make_sink
+from records import Home
+from metrics import timed, export_metrics
+from tracing import span, format_tree, profiling
 from urllib.parse import urljoin
 
 class LennarScraper(object):
-    def __init__(self):
-        self.url = 'https://www.lennar.com/Services/Rest/SearchMethods.svc/GetInventoryTabDetails'
-        self.session = requests.Session()
+    builder = 'lennar'
+
+    fields = [
+        ('Community', 'community'),
+        ('Community URL', 'community_url'),
+        ('Address', 'address'),
+        ('URL', 'url'),
+        ('Price', 'price')
+    ]
+
+    def __init__(self, output='lennar.csv', base_url='https://www.lennar.com'):
+        self.output = output
+        self.url = urljoin(base_url, '/Services/Rest/SearchMethods.svc/GetInventoryTabDetails')
+        self.session = make_session()
         self.data = {
             "CommunityID":"4531",
             "pageState":{
@@ -28,50 +43,46 @@ class LennarScraper(object):
             }
         }
 
-    def csv_save(self, data):
-        headers = [
-            'Community',
-            'Community URL',
-            'Address',
-            'URL',
-            'Price'
-        ]
+    @span('parse')
+    @timed('lennar.scrape_home_attrs')
+    def scrape_home_attrs(self, d):
+        home = {}
 
-        with open('lennar.csv', 'w') as fp:
-            writer = csv.writer(fp, quoting=csv.QUOTE_NONNUMERIC)
-            writer.writerow(headers)
+        home['community'] = d['cnm']
+        home['community_url'] = urljoin(self.url, d['cmURL'])
+        home['address'] = d['spdAdd'] +  ', ' + d['city'] + ', ' + d['stcd'] + ' ' + d['spZip']
+        home['price'] =  d['price']
+        home['url'] = urljoin(self.url, d['vtlURL'])
 
-            for d in data:
-                row = [
-                    d.get('community', ''),
-                    d.get('community_url', ''),
-                    d.get('address', ''),
-                    d.get('url', ''),
-                    d.get('price', ''),
-                ]
-                row = [ i for i in row  ]
-                writer.writerow(row)
-        
+        return Home(**home)
+
+    @span('lennar.scrape')
     def scrape(self):
-        homes = []
-        
         resp = self.session.post(self.url, json=self.data)
+        resp.raise_for_status()
         data = resp.json()
 
-        for d in data['ir']:
-            home = {}
-
-            home['community'] = d['cnm']
-            home['community_url'] = urljoin(self.url, d['cmURL'])
-            home['address'] = d['spdAdd'] +  ', ' + d['city'] + ', ' + d['stcd'] + ' ' + d['spZip']
-            home['price'] =  d['price']
-            home['url'] = urljoin(self.url, d['vtlURL'])
+        with make_sink(self.output, self.fields, builder=self.builder) as sink:
+            for d in data['ir']:
+                sink.write(self.scrape_home_attrs(d))
 
-            homes.append(home)
-            
-        self.csv_save(homes)
-        return homes
+        return sink.count
     
 if __name__ == '__main__':
-    scraper = LennarScraper()
-    scraper.scrape()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default='lennar.csv',
+                        help='output file (.csv or .jsonl, optionally .gz, .parquet, .arrow, or .db to add to an inventory database)')
+    parser.add_argument('--base-url', default='https://www.lennar.com',
+                        help='site to scrape, e.g. a local mockserver.py')
+    parser.add_argument('--profile', choices=['cprofile', 'sample'],
+                        help='profile the run, saving the results next to the output')
+    args = parser.parse_args()
+
+    export_metrics()
+
+    scraper = LennarScraper(output=args.output, base_url=args.base_url)
+
+    with profiling(args.profile, args.output):
+        scraper.scrape()
+
+    print('Time per stage:\n' + format_tree())
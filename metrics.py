@@ -0,0 +1,313 @@
+import os
+import re
+import time
+import atexit
+import logging
+import functools
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+#########################################################################
+# Metrics for a run in the Prometheus text format. Requests, caches, the
+# rate limiter, extractors and sinks all record here so a run shows where
+# the time went: waiting on the network, parsing, or sleeping to stay
+# within the rate limits.
+#
+# Set METRICS_PORT to serve them at http://localhost:<port>/metrics while
+# the run goes, or METRICS_PATH to write them to a file when it ends.
+#########################################################################
+
+# Seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+logger = logging.getLogger(__name__)
+
+def format_labels(names, values):
+    if not names:
+        return ''
+
+    escape = lambda v: str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+    return '{' + ','.join(f'{n}="{escape(v)}"' for n, v in zip(names, values)) + '}'
+
+def format_value(v):
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+class Metric(object):
+    """ A metric with a value for each combination of its labels.
+
+        Initialization components:
+            name (str): metric name
+            help (str): description of the metric
+            labelnames (list): names of the labels values are recorded under
+    """
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.labelnames)
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+
+        for name, labelnames, values, value in self.samples():
+            lines.append(f'{name}{format_labels(labelnames, values)} {format_value(value)}')
+
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        with self.lock:
+            return [
+                (self.name, self.labelnames, k, v) for k, v in sorted(self.values.items())
+            ]
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+
+            counts = self.values[key][0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+
+            self.values[key][1] += value
+            self.values[key][2] += 1
+
+    def get(self, **labels):
+        '''
+        Return the number and sum of the values observed for labels
+        '''
+        _, total, count = self.values.get(self.key(labels), (None, 0.0, 0))
+        return count, total
+
+    def samples(self):
+        samples = []
+        labelnames = self.labelnames + ('le',)
+
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                for bound, n in zip(self.buckets, counts):
+                    samples.append((f'{self.name}_bucket', labelnames, key + (bound,), n))
+
+                samples.append((f'{self.name}_bucket', labelnames, key + ('+Inf',), count))
+                samples.append((f'{self.name}_sum', self.labelnames, key, total))
+                samples.append((f'{self.name}_count', self.labelnames, key, count))
+
+        return samples
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.setdefault(metric.name, metric)
+            return self.metrics[metric.name]
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        return '\n'.join(m.render() for m in metrics) + '\n'
+
+    def dump(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            fp.write(self.render())
+        os.replace(tmp_path, path)
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_duration_seconds', 'Time from sending a request to reading its response',
+    ['host', 'endpoint', 'method'])
+HTTP_RESPONSES = REGISTRY.counter(
+    'http_responses_total', 'Responses by status code',
+    ['host', 'endpoint', 'status'])
+HTTP_RESPONSE_BYTES = REGISTRY.counter(
+    'http_response_bytes_total', 'Bytes in response bodies after decompression',
+    ['host', 'endpoint'])
+HTTP_RESPONSE_WIRE_BYTES = REGISTRY.counter(
+    'http_response_wire_bytes_total', 'Bytes in response bodies as sent, before decompression',
+    ['host', 'endpoint'])
+HTTP_ERRORS = REGISTRY.counter(
+    'http_request_errors_total', 'Requests that failed without a response',
+    ['host', 'endpoint', 'error'])
+HTTP_CONNECTIONS = REGISTRY.counter(
+    'http_connections_total', 'Connections taken from the pool by result (new or reused)',
+    ['host', 'result'])
+HTTP_CONNECTIONS_DISCARDED = REGISTRY.counter(
+    'http_connections_discarded_total', 'Connections closed because the pool was full',
+    ['host'])
+HTTP_RETRIES = REGISTRY.counter(
+    'http_retries_total', 'Requests retried by reason (status code, error or circuit_open)',
+    ['host', 'reason'])
+CIRCUIT_OPEN = REGISTRY.gauge(
+    'circuit_open', 'Whether the circuit breaker for each host is open (1) or closed (0)',
+    ['host'])
+RATELIMIT_WAIT_SECONDS = REGISTRY.counter(
+    'ratelimit_wait_seconds_total', 'Time spent waiting on the rate limiter',
+    ['host'])
+CACHE_REQUESTS = REGISTRY.counter(
+    'cache_requests_total', 'Cache lookups by result (hit or miss)',
+    ['cache', 'result'])
+PARSE_SECONDS = REGISTRY.histogram(
+    'parse_duration_seconds', 'Time spent in each extractor',
+    ['extractor'])
+RECORDS = REGISTRY.counter(
+    'records_written_total', 'Records written to each output',
+    ['output'])
+INVALID_FIELDS = REGISTRY.counter(
+    'record_invalid_fields_total', 'Record fields left out because their value was not valid',
+    ['field'])
+RECORDS_PER_SECOND = REGISTRY.gauge(
+    'records_per_second', 'Records written per second since each output was opened',
+    ['output'])
+
+# Path segments that identify a single community, home or lot
+ID_SEGMENT = re.compile(r'^(\d+|.*-\d+|\{?[0-9A-Fa-f-]{32,}\}?)$')
+
+def endpoint_label(url, max_segments=4):
+    '''
+    Return a label for the kind of page at url. API paths are used as is
+    but a path with an ID in it, or more than max_segments parts, is cut
+    down to its first part with a * for each of the rest so that, e.g.,
+    every lot page is one endpoint rather than one per state and community.
+    '''
+    segments = [s for s in urlparse(url).path.split('/') if s]
+
+    if len(segments) > max_segments or any(ID_SEGMENT.match(s) for s in segments):
+        segments = segments[:1] + ['*'] * (len(segments) - 1)
+
+    return '/' + '/'.join(segments)
+
+def record_response(method, url, resp, seconds):
+    host = urlparse(url).netloc
+    endpoint = endpoint_label(url)
+
+    HTTP_REQUEST_SECONDS.observe(seconds, host=host, endpoint=endpoint, method=method)
+    HTTP_RESPONSES.inc(host=host, endpoint=endpoint, status=resp.status_code)
+    HTTP_RESPONSE_BYTES.inc(len(resp.content), host=host, endpoint=endpoint)
+
+    # Responses answered from the cache have no body on the wire
+    if not getattr(resp, 'from_cache', False) and hasattr(resp.raw, 'tell'):
+        HTTP_RESPONSE_WIRE_BYTES.inc(resp.raw.tell(), host=host, endpoint=endpoint)
+
+def record_error(method, url, error):
+    HTTP_ERRORS.inc(host=urlparse(url).netloc, endpoint=endpoint_label(url),
+                    error=type(error).__name__)
+
+def timed(extractor):
+    '''
+    Decorator recording the time spent in the decorated function as the
+    parse time of extractor
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                PARSE_SECONDS.observe(time.perf_counter() - start, extractor=extractor)
+        return wrapper
+    return decorator
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/metrics':
+            self.send_error(404)
+            return
+
+        data = REGISTRY.render().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def start_metrics_server(port, host=''):
+    '''
+    Serve the metrics at /metrics on a background thread
+    '''
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
+
+_exported = False
+
+def export_metrics():
+    '''
+    Serve the metrics on METRICS_PORT and/or write them to METRICS_PATH
+    when the process exits, whichever are set
+    '''
+    global _exported
+
+    if _exported:
+        return
+    _exported = True
+
+    port = os.environ.get('METRICS_PORT')
+    if port:
+        start_metrics_server(int(port))
+        logger.info(f'Serving metrics on http://localhost:{port}/metrics')
+
+    path = os.environ.get('METRICS_PATH')
+    if path:
+        atexit.register(REGISTRY.dump, path)
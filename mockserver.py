@@ -0,0 +1,569 @@
+import re
+import gzip
+import json
+import math
+import time
+import uuid
+import random
+import logging
+import argparse
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+#########################################################################
+# Local stand-in for the builder sites so that full scrapes can be run and
+# load tested without touching the real servers. One server answers every
+# endpoint the scrapers use; point a scraper at it with --base-url:
+#
+#   $ python mockserver.py --port 8000 --latency 0.05 --error-rate 0.02
+#   $ python pulte.py --base-url http://localhost:8000
+#
+# The inventory is generated from a seed so every run against the same
+# settings sees the same communities and homes.
+#########################################################################
+
+# (abbreviation, name, city, lat, lng)
+STATES = [
+    ('TX', 'Texas', 'Austin', 30.27, -97.74),
+    ('FL', 'Florida', 'Orlando', 28.54, -81.38),
+    ('CA', 'California', 'Irvine', 33.68, -117.83),
+    ('NC', 'North Carolina', 'Raleigh', 35.78, -78.64),
+    ('GA', 'Georgia', 'Atlanta', 33.75, -84.39),
+    ('AZ', 'Arizona', 'Phoenix', 33.45, -112.07),
+    ('CO', 'Colorado', 'Denver', 39.74, -104.99),
+    ('VA', 'Virginia', 'Richmond', 37.54, -77.44),
+    ('SC', 'South Carolina', 'Columbia', 34.00, -81.03),
+    ('NV', 'Nevada', 'Las Vegas', 36.17, -115.14)
+]
+
+NAMES = ['Willow', 'Cedar', 'Aspen', 'Oak', 'Pine', 'Birch', 'Elm', 'Juniper', 'Maple', 'Cypress']
+PLACES = ['Ridge', 'Crossing', 'Landing', 'Park', 'Grove', 'Meadows', 'Creek', 'Point']
+STREETS = ['St', 'Ave', 'Ln', 'Ct', 'Dr', 'Way']
+PLANS = ['The Camden', 'The Hudson', 'The Palermo', 'The Belmont', 'The Sierra']
+
+# Coordinate fields used by DRHorton's Coveo queries
+LAT_FIELD = 'fcoordinatesz32xlatitude33386'
+LNG_FIELD = 'fcoordinatesz32xlongitude33386'
+
+SHEA_SEARCH_PANEL = 'p_lt_ctl03_pageplaceholder_p_lt_ctl02_FYHSearchResultsFilter_upCommunityListing'
+SHEA_QMI_PANEL = 'p_lt_ctl03_pageplaceholder_p_lt_ctl05_QMIHomes_CMSUpdatePanel1'
+SHEA_PAGE_SIZE = 3 # lots shown on a community page before View More
+
+logger = logging.getLogger(__name__)
+
+def slugify(s):
+    return re.sub(r'[^a-z0-9]+', '-', s.lower()).strip('-')
+
+def distance(lat1, lng1, lat2, lng2):
+    '''
+    Haversine distance in the units of DRHorton's dist()/1610 query
+    '''
+    lat1, lng1, lat2, lng2 = map(math.radians, [lat1, lng1, lat2, lng2])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a)) / 1610
+
+class MockSite(object):
+    """ Generated inventory and fault settings shared by every request to
+        the mock server.
+
+        Initialization components:
+            communities (int): communities per state
+            homes (int): average homes per community
+            latency (float): seconds added to every response
+            jitter (float): up to this many more seconds are added at random
+            error_rate (float): fraction of requests answered with a 502
+            drop_rate (float): fraction of requests whose connection is
+                closed without a response
+            seed (int): seed for the inventory and the faults
+    """
+    def __init__(self, communities=10, homes=8, latency=0.0, jitter=0.0,
+                 error_rate=0.0, drop_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+        self.communities = []
+        self.homes = []
+
+        rng = random.Random(seed)
+        for abbrev, state, city, lat, lng in STATES:
+            for i in range(communities):
+                self.add_community(rng, abbrev, state, city, lat, lng, homes)
+
+        self.by_cid = {c['cid']: c for c in self.communities}
+        self.by_path = {c['path']: c for c in self.communities}
+        self.homes_by_id = {h['id']: h for h in self.homes}
+
+    def add_community(self, rng, abbrev, state, city, lat, lng, homes):
+        n = len(self.communities)
+        name = f'{rng.choice(NAMES)} {rng.choice(PLACES)}'
+
+        community = {
+            'id': n,
+            'cid': '{%s}' % str(uuid.UUID(int=rng.getrandbits(128))).upper(),
+            'name': name,
+            'slug': f'{slugify(name)}-{n}',
+            'abbrev': abbrev,
+            'state': state,
+            'city': city,
+            'lat': round(lat + rng.uniform(-1.5, 1.5), 5),
+            'lng': round(lng + rng.uniform(-1.5, 1.5), 5),
+            'homes': []
+        }
+        community['path'] = f'/new-homes/{slugify(state)}/{community["slug"]}/'
+
+        for _ in range(rng.randint(0, 2 * homes)):
+            home = {
+                'id': len(self.homes),
+                'community': community,
+                'address': f'{rng.randint(100, 9999)} {rng.choice(NAMES)} {rng.choice(STREETS)}',
+                'zip': f'{rng.randint(10000, 99999)}',
+                'plan': rng.choice(PLANS),
+                'price': rng.randrange(200000, 900000, 10),
+                'sqft': rng.randint(1200, 4500),
+                'beds': rng.randint(2, 6),
+                'baths': rng.randint(2, 4),
+                'half_bath': rng.random() < 0.5,
+                'garage': rng.randint(1, 3),
+                'stories': rng.randint(1, 3)
+            }
+            community['homes'].append(home)
+            self.homes.append(home)
+
+        self.communities.append(community)
+
+    def fault(self):
+        '''
+        Return 'drop', 'error' or None for the next request after sleeping
+        for the configured latency
+        '''
+        with self.lock:
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+            r = self.rng.random()
+
+        time.sleep(delay)
+
+        if r < self.drop_rate:
+            return 'drop'
+        if r < self.drop_rate + self.error_rate:
+            return 'error'
+        return None
+
+    #####################################################################
+    # DRHorton
+    #####################################################################
+    def coveo_search(self, form):
+        '''
+        Answer a Coveo query for communities in a lat/lng range or within
+        a distance of a point
+        '''
+        aq = form.get('aq', '')
+        matches = self.communities
+
+        bounds = re.findall(r'@(%s|%s)(>=|<)(-?[\d.]+)' % (LAT_FIELD, LNG_FIELD), aq)
+        for field, op, value in bounds:
+            key = 'lat' if field == LAT_FIELD else 'lng'
+            value = float(value)
+            if op == '>=':
+                matches = [c for c in matches if c[key] >= value]
+            else:
+                matches = [c for c in matches if c[key] < value]
+
+        m = re.search(r'dist\(\S+, \S+, (-?[\d.]+), (-?[\d.]+)\)', form.get('queryFunctions', ''))
+        r = re.search(r'<(\d+)\)', aq)
+        if m and r:
+            lat, lng = float(m.group(1)), float(m.group(2))
+            matches = [
+                c for c in matches
+                if distance(lat, lng, c['lat'], c['lng']) < float(r.group(1))
+            ]
+
+        first = int(form.get('firstResult', 0))
+        count = int(form.get('numberOfResults', 10))
+
+        return {
+            'totalCount': len(matches),
+            'results': [
+                {'raw': {'fid33386': c['cid'], LAT_FIELD: c['lat'], LNG_FIELD: c['lng']}}
+                for c in matches[first:first + count]
+            ]
+        }
+
+    def drhorton_home(self, h):
+        c = h['community']
+        baths = h['baths'] + (0.5 if h['half_bath'] else 0)
+
+        return f'''<div class="card-wrapper">
+    <div class="card">
+        <div class="info-frame">
+            <p class="title">{h['plan']}</p>
+            <p>
+                <a href="/{slugify(c['state'])}/{slugify(c['city'])}/{slugify(h['address'])}/{h['id']}">
+                    {h['address']}
+                    {c['city']}, {c['abbrev']} {h['zip']}
+                </a>
+            </p>
+        </div>
+        <div class="sq-ft"><p><strong>{h['sqft']:,}</strong> Sq. Ft.</p></div>
+        <div class="cost"><p class="price">${h['price']:,}</p></div>
+        <ul class="specs">
+            <li><strong>{h['stories']}</strong> Story</li>
+            <li><strong>{h['beds']}</strong> Bed</li>
+            <li><strong>{baths:g}</strong> Bath</li>
+            <li><strong>{h['garage']}</strong> Car</li>
+        </ul>
+    </div>
+</div>'''
+
+    def movein_ready(self, form):
+        community = self.by_cid.get(form.get('ItemId'))
+        homes = community['homes'] if community else []
+
+        start = int(form.get('StartIndex', 0))
+        count = int(form.get('Count', 8))
+
+        return {
+            'TotalItems': len(homes),
+            'HtmlItems': [self.drhorton_home(h) for h in homes[start:start + count]]
+        }
+
+    #####################################################################
+    # Pulte
+    #####################################################################
+    def pulte_locations(self):
+        locations = [{'States': [{'StateName': s[1]} for s in STATES]}]
+        return f'''<html><body>
+<script>
+    LocationSelectionData.locations = {json.dumps(locations)};
+</script>
+</body></html>'''
+
+    def pulte_home(self, h):
+        c = h['community']
+        return f'''<div class="HomeDesignSummary HomeDesignSummary--qmi">
+    <div class="community-name"><a href="/homes/{c['abbrev'].lower()}/{slugify(c['city'])}/{c['slug']}">Community: {c['name']}</a></div>
+    <div class="address-phone">
+        <div class="address">
+            {h['address']}
+            {c['city']}, {c['abbrev']} {h['zip']}
+        </div>
+    </div>
+    <div class="stats">
+        <div class="stat-line data-value">{h['beds']} Bed</div>
+        <div class="stat-line data-value">{h['baths']} Bath</div>
+        <div class="data-value">${h['price']:,}</div>
+    </div>
+    <a class="btn" href="/homes/{c['abbrev'].lower()}/{slugify(c['city'])}/qmi/{h['id']}">View Home</a>
+</div>'''
+
+    def pulte_search(self, params):
+        homes = [h for h in self.homes if h['community']['state'] == params.get('state')]
+
+        size = int(params.get('pageSize', 50))
+        page = int(params.get('pageNumber', 0))
+
+        return '\n'.join(self.pulte_home(h) for h in homes[page * size:(page + 1) * size])
+
+    #####################################################################
+    # Ryan Homes
+    #####################################################################
+    def ryanhomes_search(self, data):
+        return {
+            'options': {
+                'states': [{'value': s[0], 'text': s[1]} for s in STATES]
+            },
+            'items': [
+                {
+                    'id': h['id'],
+                    'name': h['plan'].replace('The ', ''),
+                    'productSeoUrl': slugify(h['plan']),
+                    'state': h['community']['abbrev'],
+                    'city': h['community']['city'],
+                    'communitySeoUrl': h['community']['slug'],
+                    'squareFootage': h['sqft'],
+                    'startingPrice': h['price'],
+                    'numberGarageSpaces': h['garage'],
+                    'bedrooms': h['beds'],
+                    'bathrooms': h['baths'],
+                    'halfBath': h['half_bath']
+                }
+                for h in self.homes
+            ]
+        }
+
+    def ryanhomes_home(self, home_id):
+        h = self.homes_by_id.get(home_id)
+        if h is None:
+            return None
+
+        c = h['community']
+        return f'''<html><body><ul class="header-details">
+    <li class="header-locDetails">{h['address']}, {c['city']}, {c['abbrev']} {h['zip']}</li>
+</ul></body></html>'''
+
+    #####################################################################
+    # Shea Homes. The ASP.NET postbacks are answered with a delta made of
+    # length|type|id|content| entries.
+    #####################################################################
+    def shea_form(self, action, panel_id, panel, inputs):
+        return f'''<html><body>
+<form method="post" action="{action}" id="form">
+    <input type="hidden" name="__VIEWSTATE" value="mock" />
+    {inputs}
+    <div id="{panel_id}">{panel}</div>
+</form>
+</body></html>'''
+
+    def shea_delta(self, panel_id, panel):
+        return f'1|#||4|{len(panel)}|updatePanel|{panel_id}|{panel}|'
+
+    def shea_search(self):
+        inputs = '''<input type="submit" name="p$lt$ctl03$pageplaceholder$p$lt$ctl02$FYHSearchResultsFilter$btnHiddenDeferInitialDataLoad" id="btnHiddenDeferInitialDataLoad" value="" />
+    <input type="checkbox" name="quickmovein" checked="" />
+    <select name="state"><option value="any">Any</option></select>
+    <select name="type"><option value="any">Any</option></select>'''
+        return self.shea_form('/new-homes/', SHEA_SEARCH_PANEL, '', inputs)
+
+    def shea_communities(self):
+        panel = '\n'.join(
+            f'<a class="card-community" href="{c["path"]}">{c["name"]}</a>'
+            for c in self.communities if c['homes']
+        )
+        return self.shea_delta(SHEA_SEARCH_PANEL, panel)
+
+    def shea_lots(self, community, homes):
+        cards = '\n'.join(
+            f'<div class="card"><div class="card-content"><a href="{community["path"]}lot-{h["id"]}/">Lot {h["id"]}</a>'
+            f'<p>{h["plan"]} | Available Now</p></div></div>'
+            for h in homes
+        )
+        return f'<section id="qmi-homes"><h2>AVAILABLE QUICK MOVE-IN HOMES</h2>\n{cards}\n</section>'
+
+    def shea_community(self, community):
+        homes = community['homes']
+        inputs = ''
+
+        if len(homes) > SHEA_PAGE_SIZE:
+            inputs = f'<input type="submit" name="{SHEA_QMI_PANEL.replace("_", "$")}$btnViewMore" value="View More" />'
+
+        panel = self.shea_lots(community, homes[:SHEA_PAGE_SIZE])
+        return self.shea_form(community['path'], SHEA_QMI_PANEL, panel, inputs)
+
+    def shea_view_more(self, community):
+        return self.shea_delta(SHEA_QMI_PANEL, self.shea_lots(community, community['homes']))
+
+    def shea_lot(self, home_id):
+        h = self.homes_by_id.get(home_id)
+        if h is None:
+            return None
+
+        c = h['community']
+        baths = h['baths'] + (0.5 if h['half_bath'] else 0)
+
+        return f'''<html><body><section class="about">
+    <div class="about-address">
+        <p class="address-label">Address</p>
+        {h['address']}
+        {c['city']}, {c['abbrev']} {h['zip']}
+    </div>
+    <p class="large">
+        Priced From ${h['price']:,}
+        {h['sqft']:,} Sq. Ft
+        Homesite {h['id']} is ready now.
+    </p>
+    <ul class="home-features">
+        <li><img src="/icons/stories.svg" alt="Stories Icon"/><p>{h['stories']}</p></li>
+        <li><img src="/icons/bed.svg" alt="Bedroom Icon"/><p>{h['beds']}</p></li>
+        <li><img src="/icons/bath.svg" alt="Bathroom Icon"/><p>{baths:g}</p></li>
+        <li><img src="/icons/garage.svg" alt="Garage Icon"/><p>{h['garage']}</p></li>
+    </ul>
+</section></body></html>'''
+
+    #####################################################################
+    # Lennar
+    #####################################################################
+    def lennar_inventory(self, data):
+        page = data.get('pageState', {})
+        size = int(page.get('ps', 17))
+        start = (int(page.get('pn', 1)) - 1) * size
+
+        return {
+            'ir': [
+                {
+                    'cnm': h['community']['name'],
+                    'cmURL': f"/new-homes/{h['community']['abbrev'].lower()}/{h['community']['slug']}",
+                    'spdAdd': h['address'],
+                    'city': h['community']['city'],
+                    'stcd': h['community']['abbrev'],
+                    'spZip': h['zip'],
+                    'price': f"${h['price']:,}",
+                    'vtlURL': f"/new-homes/{h['community']['abbrev'].lower()}/homesite-{h['id']}"
+                }
+                for h in self.homes[start:start + size]
+            ]
+        }
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep connections alive like the real sites
+    disable_nagle_algorithm = True # headers and body are written separately
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length).decode('utf-8')
+
+    def read_form(self):
+        return {
+            k: v[0] for k, v in parse_qs(self.read_body(), keep_blank_values=True).items()
+        }
+
+    def send(self, status, body, content_type='text/html; charset=utf-8'):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+            content_type = 'application/json; charset=utf-8'
+
+        data = body.encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = gzip.compress(data, compresslevel=1)
+            self.send_header('Content-Encoding', 'gzip')
+
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_fault(self):
+        '''
+        Apply the site's latency and return True if the request was
+        failed on purpose
+        '''
+        fault = self.server.site.fault()
+
+        if fault == 'drop':
+            self.close_connection = True
+            return True
+        if fault == 'error':
+            self.read_body() # so the next request on the connection can be read
+            self.send(502, 'Bad Gateway')
+            return True
+
+        return False
+
+    def do_GET(self):
+        if self.handle_fault():
+            return
+
+        site = self.server.site
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        path = url.path
+
+        body = None
+        m = re.search(r'/(\d+)$', path)
+
+        if path == '/api/Qmi/Search':
+            body = site.pulte_search(params)
+        elif path.startswith('/homes/'):
+            body = site.pulte_locations()
+        elif path.startswith('/find-your-home/') and m:
+            body = site.ryanhomes_home(int(m.group(1)))
+        elif path == '/new-homes/':
+            body = site.shea_search()
+        elif path in site.by_path:
+            body = site.shea_community(site.by_path[path])
+        elif path.startswith('/new-homes/'):
+            m = re.search(r'/lot-(\d+)/$', path)
+            if m:
+                body = site.shea_lot(int(m.group(1)))
+
+        if body is None:
+            self.send(404, 'Not Found')
+        else:
+            self.send(200, body)
+
+    def do_POST(self):
+        if self.handle_fault():
+            return
+
+        site = self.server.site
+        path = urlparse(self.path).path
+
+        if path == '/coveo/rest/v2':
+            self.send(200, site.coveo_search(self.read_form()))
+        elif path == '/api/drh/moveinreadyapi/getrelated':
+            self.send(200, site.movein_ready(self.read_form()))
+        elif path == '/homelist/search':
+            self.send(200, site.ryanhomes_search(json.loads(self.read_body() or '{}')))
+        elif path.endswith('/GetInventoryTabDetails'):
+            self.send(200, site.lennar_inventory(json.loads(self.read_body() or '{}')))
+        elif path == '/new-homes/':
+            self.read_body()
+            self.send(200, site.shea_communities(), 'text/plain; charset=utf-8')
+        elif path in site.by_path:
+            self.read_body()
+            self.send(200, site.shea_view_more(site.by_path[path]), 'text/plain; charset=utf-8')
+        else:
+            self.read_body()
+            self.send(404, 'Not Found')
+
+def make_mock_server(site=None, host='localhost', port=8000):
+    server = ThreadingHTTPServer((host, port), MockRequestHandler)
+    server.daemon_threads = True
+    server.site = MockSite() if site is None else site
+    return server
+
+def start_mock_server(site=None, host='localhost', port=0):
+    '''
+    Serve site on a background thread and return the server along with
+    its base URL. A port of 0 picks a free port.
+    '''
+    server = make_mock_server(site, host, port)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server, f'http://{host}:{server.server_address[1]}'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--communities', type=int, default=10,
+                        help='communities per state')
+    parser.add_argument('--homes', type=int, default=8,
+                        help='average homes per community')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='up to this many more seconds added at random')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with a 502')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='fraction of connections closed without a response')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    FORMAT = "%(asctime)s [ %(filename)s:%(lineno)s - %(funcName)s() ] %(message)s"
+    logging.basicConfig(format=FORMAT, datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO)
+
+    site = MockSite(communities=args.communities, homes=args.homes,
+                    latency=args.latency, jitter=args.jitter,
+                    error_rate=args.error_rate, drop_rate=args.drop_rate,
+                    seed=args.seed)
+
+    server = make_mock_server(site, args.host, args.port)
+
+    logger.info(f'Serving {len(site.communities)} communities and {len(site.homes)} homes '
+                f'on http://{args.host}:{args.port}')
+    server.serve_forever()
@@ -0,0 +1,71 @@
+import threading
+
+from queue import Queue
+from tracing import in_context
+
+# Marks the end of a worker's output
+_DONE = object()
+
+class _Error:
+    def __init__(self, ex):
+        self.ex = ex
+
+def run_stage(func, inputs, workers):
+    '''
+    Run func over every item in inputs on a pool of worker threads and
+    yield each of the values in the iterables func returns as soon as
+    they're ready. Results are yielded in the order they are produced,
+    not the order of inputs.
+
+    inputs can be another stage's generator so that stages can be chained
+    into a pipeline where each stage has its own number of workers. The
+    inputs are read on a separate thread and at most 2 * workers of them
+    are queued up at a time.
+
+    An exception raised by func is re-raised in the caller.
+    '''
+    in_q = Queue(maxsize=2 * workers)
+    out_q = Queue()
+
+    def feed():
+        try:
+            for item in inputs:
+                in_q.put(item)
+        except BaseException as ex:
+            out_q.put(_Error(ex))
+        finally:
+            for _ in range(workers):
+                in_q.put(_DONE)
+
+    def work():
+        try:
+            while True:
+                item = in_q.get()
+                if item is _DONE:
+                    break
+                for result in func(item):
+                    out_q.put(result)
+        except BaseException as ex:
+            out_q.put(_Error(ex))
+        finally:
+            out_q.put(_DONE)
+
+    # Threads run in a copy of the caller's context so their spans are
+    # placed under the caller's
+    threads = [threading.Thread(target=in_context(feed), daemon=True)]
+    threads += [
+        threading.Thread(target=in_context(work), daemon=True) for _ in range(workers)
+    ]
+
+    for t in threads:
+        t.start()
+
+    done = 0
+    while done < workers:
+        result = out_q.get()
+        if result is _DONE:
+            done += 1
+        elif isinstance(result, _Error):
+            raise result.ex
+        else:
+            yield result
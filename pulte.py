@@ -1,17 +1,40 @@
 import re
-import csv
 import json
-import time
+import argparse
 import logging
 import requests
 
+from transport import make_session
+from pipeline import run_stage
+from sinks import make_sink
+from records import Home
+from checkpoint import Checkpoint, checkpoint_path
 from urllib.parse import urljoin
-from bs4 import BeautifulSoup
+from parsers import make_soup
+from metrics import timed, export_metrics
+from tracing import span, format_tree, profiling
+from functools import partial
 
 class PulteScraper(object):
-    def __init__(self):
-        self.url = 'https://www.pulte.com/api/Qmi/Search'
-        self.session = requests.Session()
+    builder = 'pulte'
+
+    fields = [
+        ('Community', 'community'),
+        ('Community URL', 'community_url'),
+        ('Address', 'address'),
+        ('URL', 'url'),
+        ('Price', 'price')
+    ]
+
+    def __init__(self, concurrency=4, output='pulte.csv', resume=False,
+                 base_url='https://www.pulte.com'):
+        self.output = output
+        self.resume = resume # continue from the checkpoint of an interrupted run
+        self.checkpoint = None
+        self.concurrency = concurrency # states scraped at once
+        self.base_url = base_url
+        self.url = urljoin(base_url, '/api/Qmi/Search')
+        self.session = make_session(pool_size=concurrency)
         self.headers = {
             'X-Requested-With': 'XMLHttpRequest'
         }
@@ -37,30 +60,6 @@ class PulteScraper(object):
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.DEBUG)
 
-    def csv_save(self, data):
-        headers = [
-            'Community',
-            'Community URL',
-            'Address',
-            'URL',
-            'Price'
-        ]
-
-        with open('pulte.csv', 'w') as fp:
-            writer = csv.writer(fp, quoting=csv.QUOTE_NONNUMERIC)
-            writer.writerow(headers)
-
-            for d in data:
-                row = [
-                    d.get('community', ''),
-                    d.get('community_url', ''),
-                    d.get('address', ''),
-                    d.get('url', ''),
-                    d.get('price', ''),
-                ]
-                row = [ i for i in row  ]
-                writer.writerow(row)
-
     def scrape_listings(self, soup):
         homes = []
         
@@ -89,14 +88,20 @@ class PulteScraper(object):
             
             d = div.find(match_price)
             home['price'] = d.text.strip()
-            homes.append(home)
+            homes.append(Home(**home))
 
         self.logger.info(f'Returning {len(homes)} homes')
         return homes
 
+    @span('parse')
+    @timed('pulte.parse_listings')
+    def parse_listings(self, html):
+        return self.scrape_listings(make_soup(html))
+
     def get_states(self):
-        resp = self.session.get('https://www.pulte.com/homes/georgia')
-        soup = BeautifulSoup(resp.text, 'html.parser')
+        resp = self.session.get(urljoin(self.base_url, '/homes/georgia'))
+        resp.raise_for_status()
+        soup = make_soup(resp.text)
 
         r = re.compile(r'LocationSelectionData.locations =\s+(\[[^;]+)')
         match_script = lambda t: t.name == 'script' and re.search(r, t.text.strip())
@@ -113,38 +118,120 @@ class PulteScraper(object):
         self.logger.info(f'Returning {len(states)} states')
         return states
         
-    def scrape(self):
-        homes = []        
-        states = self.get_states()
+    def iter_state_pages(self, state, page=0):
+        '''
+        Yield the page number and list of homes on each page of search
+        results for state, starting at page
+        '''
+        params = dict(self.params)
+        params['pageNumber'] = page
+        params['state'] = state
+
+        while True:
+            self.logger.info(f"Scraping page {params['pageNumber']} for state {state}")
+
+            resp = self.session.get(self.url, headers=self.headers, params=params)
+            resp.raise_for_status()
+
+            if len(resp.text.strip()) == 0:
+                break
+
+            yield params['pageNumber'], self.parse_listings(resp.text)
+
+            params['pageNumber'] += 1
+
+    def iter_state_units(self, state):
+        '''
+        Yield ([state, page], homes) for each page of state that isn't in
+        the checkpoint, then ([state, None], []) once the state is finished.
+        A state whose page can't be loaded is added to self.failed and its
+        remaining pages are left pending so --resume tries them again.
+        '''
+        page = 0
+        while self.checkpoint.is_done('pages', [state, page]):
+            page += 1
+
+        num_homes = 0
+
+        try:
+            for page, homes in self.iter_state_pages(state, page):
+                num_homes += len(homes)
+                yield [state, page], homes
+        except requests.exceptions.RequestException as e:
+            self.logger.warning(f'Failed to get homes for state {state}: {e}')
+            self.failed.append(state)
+            return
+
+        self.logger.info(f'Scraped {num_homes} for state {state}')
+        yield [state, None], []
+
+    def iter_units(self):
+        '''
+        Yield the pages of homes as they are scraped, paging through up to
+        self.concurrency states at once
+        '''
+        with span('discovery'):
+            states = self.checkpoint.get_work('states', self.get_states)
 
-        for state in states:
-            state_homes = []
+        states = [
+            s for s in states if not self.checkpoint.is_done('pages', [s, None])
+        ]
+        return run_stage(self.iter_state_units, states, self.concurrency)
 
-            self.params['pageNumber'] = 0
-            self.params['state'] = state
-            
-            while True:
-                self.logger.info(f"Scraping page {self.params['pageNumber']} for state {state}")
+    #########################################################################
+    # Work units for a distributed crawl (see workqueue.py). Each unit is a
+    # [state, page] pair and the next page is only known to exist once the
+    # current one comes back with homes, so it's queued as a new unit.
+    #########################################################################
+    def get_work_units(self):
+        return [[state, 0] for state in self.get_states()]
 
-                resp = self.session.get(self.url, headers=self.headers, params=self.params)
-                if len(resp.text.strip()) == 0:
-                    break
-            
-                soup = BeautifulSoup(resp.text, 'html.parser')
+    def process_work_unit(self, unit):
+        state, page = unit
 
-                state_homes += self.scrape_listings(soup)
-                homes += state_homes
+        for page, homes in self.iter_state_pages(state, page):
+            return homes, [[state, page + 1]]
 
-                self.params['pageNumber'] += 1
-                time.sleep(1)
+        return [], []
 
-            self.logger.info(f'Scraped {len(state_homes)} for state {state}')
+    @span('pulte.scrape')
+    def scrape(self):
+        self.checkpoint = Checkpoint(checkpoint_path(self.output, self.builder), self.resume)
+        self.failed = []
 
-        self.logger.info(f'Scraped {len(homes)} in total')
-        self.csv_save(homes)
+        with make_sink(self.output, self.fields, append=self.resume, builder=self.builder) as sink:
+            for unit, homes in self.iter_units():
+                sink.write_many(homes)
+                sink.after_flush(partial(self.checkpoint.mark_done, 'pages', unit))
 
-        return homes
+            sink.close(finished=not self.failed)
+
+        # Keep the checkpoint so --resume can retry the failed states
+        self.checkpoint.close(finished=not self.failed)
+
+        if self.failed:
+            self.logger.warning(f'Failed to get homes for {len(self.failed)} states, run with --resume to retry them')
+
+        self.logger.info(f'Scraped {sink.count} in total')
+        return sink.count
     
 if __name__ == '__main__':
-    scraper = PulteScraper()
-    scraper.scrape()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default='pulte.csv',
+                        help='output file (.csv or .jsonl, optionally .gz, .parquet, .arrow, or .db to add to an inventory database)')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from where the last run stopped')
+    parser.add_argument('--base-url', default='https://www.pulte.com',
+                        help='site to scrape, e.g. a local mockserver.py')
+    parser.add_argument('--profile', choices=['cprofile', 'sample'],
+                        help='profile the run, saving the results next to the output')
+    args = parser.parse_args()
+
+    export_metrics()
+
+    scraper = PulteScraper(output=args.output, resume=args.resume, base_url=args.base_url)
+
+    with profiling(args.profile, args.output):
+        scraper.scrape()
+
+    scraper.logger.info('Time per stage:\n' + format_tree())
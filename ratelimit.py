@@ -0,0 +1,217 @@
+import os
+import time
+import threading
+import requests
+import metrics
+
+from tracing import span
+from retry import get_retry_policy
+
+from urllib.parse import urlparse
+from redis import StrictRedis
+from redis.exceptions import RedisError
+
+# Requests per second allowed against each builder's site. Hosts not listed
+# here get DEFAULT_RATE.
+DEFAULT_RATE = 1.0
+DEFAULT_BURST = 2
+
+HOST_RATES = {
+    'www.drhorton.com': 2.0,
+    'www.pulte.com': 1.0,
+    'www.ryanhomes.com': 1.0,
+    'www.sheahomes.com': 1.0,
+    'www.lennar.com': 1.0,
+}
+
+#########################################################################
+# Token bucket shared by every process talking to the same Redis server.
+#
+# Each call takes a token whether or not one is available. If the bucket
+# goes negative the caller is told how long to wait for its token so the
+# callers queue up behind each other instead of all retrying at once.
+# TIME is read inside the script so every worker uses the same clock.
+# Redis before 5 only allows writes after TIME once the script switches
+# to replicating its effects with redis.replicate_commands().
+#########################################################################
+TOKEN_BUCKET_SCRIPT = '''
+if redis.replicate_commands then redis.replicate_commands() end
+
+local key = KEYS[1]
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+
+local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+local tokens = tonumber(bucket[1])
+local ts = tonumber(bucket[2])
+
+if tokens == nil then
+    tokens = burst
+    ts = now
+end
+
+tokens = math.min(burst, tokens + (now - ts) * rate) - 1
+
+redis.call('HMSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', key, math.ceil((burst - tokens) / rate * 1000) + 1000)
+
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+'''
+
+class LocalRateLimiter:
+    """ Per-host token bucket for a single process.
+
+        Initialization components:
+            rates (dict): requests per second keyed by host
+            burst (int): number of requests that can be made back to back
+                before the rate applies
+    """
+    def __init__(self, rates=None, burst=DEFAULT_BURST):
+        self.rates = dict(HOST_RATES if rates is None else rates)
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def rate(self, host):
+        return self.rates.get(host, DEFAULT_RATE)
+
+    def reserve(self, host):
+        """Take a token for host and return the seconds to wait for it"""
+        rate = self.rate(host)
+        now = time.monotonic()
+
+        with self.lock:
+            tokens, ts = self.buckets.get(host, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - ts) * rate) - 1
+            self.buckets[host] = (tokens, now)
+
+        return max(0.0, -tokens / rate)
+
+    def acquire(self, host):
+        """Block until a request to host is within budget"""
+        wait = self.reserve(host)
+        if wait > 0:
+            metrics.RATELIMIT_WAIT_SECONDS.inc(wait, host=host)
+            time.sleep(wait)
+
+class RedisRateLimiter(LocalRateLimiter):
+    """ Per-host token bucket stored in Redis so that any number of
+        processes share one request budget per host.
+
+        Initialization components:
+            client: a Redis client (if not set, a localhost:6379
+                default connection is used).
+            rates (dict): requests per second keyed by host
+            burst (int): number of requests that can be made back to back
+                before the rate applies
+            prefix (str): prefix for the bucket keys
+    """
+    def __init__(self, client=None, rates=None, burst=DEFAULT_BURST, prefix='ratelimit'):
+        super().__init__(rates=rates, burst=burst)
+
+        self.client = (
+            StrictRedis(host='localhost',
+                        port=6379,
+                        db=0)
+            if client is None else client
+        )
+
+        self.prefix = prefix
+        self.script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def reserve(self, host):
+        key = f'{self.prefix}:{host}'
+        wait = self.script(keys=[key], args=[self.rate(host), self.burst])
+        return float(wait)
+
+class RateLimitedSession(requests.Session):
+    """ requests.Session that retries failed requests, waits on a rate
+        limiter before every attempt and records each attempt's metrics.
+
+        Initialization components:
+            limiter: rate limiter (if not set, the one shared by the
+                process is used)
+            retry: retry policy (if not set, the one shared by the
+                process is used)
+            timeout: default timeout for requests made without one, as
+                seconds or a (connect, read) tuple
+    """
+    def __init__(self, limiter=None, retry=None, timeout=None):
+        super().__init__()
+        self.limiter = get_rate_limiter() if limiter is None else limiter
+        self.retry = get_retry_policy() if retry is None else retry
+        self.timeout = timeout
+
+    def send_once(self, method, url, *args, **kwargs):
+        with span('ratelimit'):
+            self.limiter.acquire(urlparse(url).netloc)
+
+        start = time.perf_counter()
+        try:
+            resp = super().request(method, url, *args, **kwargs)
+        except requests.exceptions.RequestException as e:
+            metrics.record_error(method, url, e)
+            raise
+
+        metrics.record_response(method, url, resp, time.perf_counter() - start)
+        return resp
+
+    def request(self, method, url, *args, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        with span('fetch'):
+            return self.retry.call(
+                urlparse(url).netloc, lambda: self.send_once(method, url, *args, **kwargs)
+            )
+
+def parse_rates(s):
+    '''
+    Parse a comma separated list of host=rate pairs such as
+    "localhost:8000=50,www.pulte.com=0.5"
+    '''
+    rates = {}
+
+    for pair in s.split(','):
+        if pair.strip():
+            host, rate = pair.rsplit('=', 1)
+            rates[host.strip()] = float(rate)
+
+    return rates
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+def get_rate_limiter():
+    '''
+    Return the rate limiter shared by all scrapers in this process. If
+    RATELIMIT_REDIS_URL is set the budget is shared through Redis with
+    every other process using the same server. RATELIMIT_RATES adds to or
+    overrides HOST_RATES, e.g. to lift the limit for a local mock server.
+    '''
+    global _limiter
+
+    with _limiter_lock:
+        if _limiter is None:
+            rates = dict(HOST_RATES)
+            rates.update(parse_rates(os.environ.get('RATELIMIT_RATES', '')))
+
+            _limiter = LocalRateLimiter(rates=rates)
+
+            url = os.environ.get('RATELIMIT_REDIS_URL')
+            if url:
+                client = StrictRedis.from_url(url)
+                try:
+                    client.ping()
+                except RedisError as ex:
+                    exit(f'Failed to connect to Redis - {ex}, exiting...' )
+
+                _limiter = RedisRateLimiter(client=client, rates=rates)
+
+    return _limiter
@@ -0,0 +1,148 @@
+import re
+import sys
+import logging
+import metrics
+
+#########################################################################
+# The record every scraper produces for a home. Listings give numbers as
+# text ("$349,990", "2,150", "2.5") so they are parsed once here, when the
+# record is made, and everything downstream gets ints and floats.
+#
+# Records use __slots__ rather than a dict per home, and repeated values
+# (community names and URLs, small floats) are shared between records, so
+# a home takes less than half the memory it did as a dict of strings.
+#########################################################################
+
+# The first number in a string such as "$349,990", "From $1,200,000" or
+# "2.5 Baths"
+NUMBER = re.compile(r'\d[\d,]*(?:\.\d+)?')
+
+# Field -> (type, lowest valid value, highest valid value). Stories, baths
+# and garages come in halves, e.g. 1.5 story or a 2.5 car garage.
+NUMERIC_FIELDS = {
+    'price': (int, 1000, 100000000),
+    'sqft': (int, 100, 100000),
+    'bed': (int, 0, 50),
+    'bath': (float, 0, 50),
+    'car': (float, 0, 50),
+    'story': (float, 0, 10)
+}
+
+# Fields whose values repeat across many homes
+SHARED_FIELDS = ('community', 'community_url')
+
+# State at the end of an address, e.g. "123 Main St Austin, TX 78701"
+STATE = re.compile(r',\s*([A-Z]{2})\s+\d{5}(?:-\d{4})?$')
+
+logger = logging.getLogger(__name__)
+
+_floats = {}
+
+def parse_number(value):
+    '''
+    Return the first number in value as a float, value itself if it is
+    already a number, or None if there isn't one
+    '''
+    if value is None or isinstance(value, (int, float)):
+        return value
+
+    m = NUMBER.search(value)
+    if m is None:
+        return None
+
+    return float(m.group().replace(',', ''))
+
+class Home(object):
+    """ A home for sale. Numeric fields are parsed from text and checked
+        against NUMERIC_FIELDS. A value that isn't valid is logged, counted
+        and left out rather than failing the whole record.
+
+        Initialization components:
+            url (str): listing URL
+            address (str): street address
+            community (str): community name
+            community_url (str): community URL
+            price (int): price in dollars
+            sqft (int): square feet
+            bed (int): bedrooms
+            bath (float): bathrooms, counting half baths as 0.5
+            car (float): garage spaces
+            story (float): stories
+            blurb (str): listing text
+    """
+    __slots__ = ('url', 'address', 'community', 'community_url', 'price', 'sqft',
+                 'bed', 'bath', 'car', 'story', 'blurb')
+
+    def __init__(self, **fields):
+        unknown = set(fields) - set(self.__slots__)
+        if unknown:
+            raise TypeError(f"Unknown home fields: {', '.join(sorted(unknown))}")
+
+        for name in self.__slots__:
+            value = fields.get(name)
+
+            if value is not None:
+                if name in NUMERIC_FIELDS:
+                    value = self.parse_field(name, value, fields.get('url'))
+                elif name in SHARED_FIELDS:
+                    value = sys.intern(value)
+
+            setattr(self, name, value)
+
+    @staticmethod
+    def parse_field(name, value, url):
+        type_, low, high = NUMERIC_FIELDS[name]
+
+        number = parse_number(value)
+        if number is None:
+            return None
+
+        if not low <= number <= high or (type_ is int and number != int(number)):
+            logger.warning(f'Invalid {name} {value!r} for home at {url}')
+            metrics.INVALID_FIELDS.inc(field=name)
+            return None
+
+        if type_ is int:
+            return int(number)
+
+        number = float(number)
+        return _floats.setdefault(number, number)
+
+    @property
+    def state(self):
+        '''
+        Two letter state code from the address
+        '''
+        m = STATE.search(self.address or '')
+        return m and m.group(1)
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+    def to_dict(self):
+        '''
+        Return the fields that are set as a dict
+        '''
+        return {
+            name: getattr(self, name) for name in self.__slots__
+            if getattr(self, name) is not None
+        }
+
+    def get(self, name, default=None):
+        value = getattr(self, name, None)
+        return default if value is None else value
+
+    def __eq__(self, other):
+        return isinstance(other, Home) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f'Home({self.to_dict()!r})'
+
+def json_default(obj):
+    '''
+    default= hook for json.dump() and json.dumps() that writes homes as dicts
+    '''
+    if isinstance(obj, Home):
+        return obj.to_dict()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
@@ -1,37 +1,72 @@
 import json
 import zlib
+import metrics
 
 from datetime import datetime, timedelta
-from redis import StrictRedis
+from redis import StrictRedis, ConnectionPool
+
+_pools = {}
+
+def get_connection_pool(host='localhost', port=6379, db=0, **kwargs):
+    """Return the connection pool shared by all clients of host:port/db"""
+    key = (host, port, db)
+    if key not in _pools:
+        _pools[key] = ConnectionPool(host=host, port=port, db=db, **kwargs)
+    return _pools[key]
 
 # https://github.com/kjam/wswp/blob/master/code/chp3/rediscache.py
 class RedisCache:
     """ Initialization components:
             client: a Redis client connected to the key-value database for
                 the webcrawling cache (if not set, a localhost:6379
-                default connection is used).
+                default connection from the shared pool is used).
             encoding (str): character encoding for serialization
             compress (bool): boolean indicating whether compression with zlib should be used
+            namespace (str): prefix for the keys of this cache so that several
+                caches can share a database
+            expires (timedelta): how long values in this namespace are kept
+            batch_size (int): most keys sent to Redis in one round trip by
+                get_many and set_many
     """
-    def __init__(self, client=None, encoding='utf-8', compress=False):
+    def __init__(self, client=None, encoding='utf-8', compress=False,
+                 namespace=None, expires=timedelta(days=2), batch_size=500):
         self.client = (
-            StrictRedis(host='localhost', 
-                        port=6379, 
-                        db=0)
+            StrictRedis(connection_pool=get_connection_pool())
             if client is None else client
         )
 
         self.encoding = encoding
         self.compress = compress
+        self.namespace = namespace
+        self.expires = expires
+        self.batch_size = batch_size
+
+    @property
+    def name(self):
+        return f"redis:{self.namespace or 'default'}"
+
+    def key(self, key):
+        return f'{self.namespace}:{key}' if self.namespace else key
+
+    def decode(self, record):
+        if self.compress:
+            record = zlib.decompress(record)
+        return record.decode(self.encoding)
+
+    def encode(self, val):
+        data = val.encode(self.encoding)
+        if self.compress:
+            data = zlib.compress(data)
+        return data
 
     def __getitem__(self, key):
         """Load data from Redis for given URL"""
-        record = self.client.get(key)
+        record = self.client.get(self.key(key))
         if record:
-            if self.compress:
-                record = zlib.decompress(record)
-            return record.decode(self.encoding)
+            metrics.CACHE_REQUESTS.inc(cache=self.name, result='hit')
+            return self.decode(record)
         else:
+            metrics.CACHE_REQUESTS.inc(cache=self.name, result='miss')
             # URL has not yet been cached
             raise KeyError(key + ' does not exist')
 
@@ -40,7 +75,32 @@ class RedisCache:
         if not key or not val:
             return
 
-        data = val.encode(self.encoding)
-        if self.compress:
-            data = zlib.compress(data)
-        self.client.setex(key, timedelta(days=2), data) # Expires in 2 days
+        self.client.setex(self.key(key), self.expires, self.encode(val))
+
+    def get_many(self, keys):
+        """Load data from Redis for all of keys using MGET. Returns a dict
+        with the keys that were found."""
+        keys = list(keys)
+        found = {}
+
+        for i in range(0, len(keys), self.batch_size):
+            batch = keys[i:i + self.batch_size]
+            records = self.client.mget([self.key(k) for k in batch])
+
+            for k, record in zip(batch, records):
+                if record:
+                    found[k] = self.decode(record)
+
+        metrics.CACHE_REQUESTS.inc(len(found), cache=self.name, result='hit')
+        metrics.CACHE_REQUESTS.inc(len(keys) - len(found), cache=self.name, result='miss')
+        return found
+
+    def set_many(self, mapping):
+        """Save all of the key/value pairs in mapping to Redis using a pipeline"""
+        items = [(k, v) for k, v in mapping.items() if k and v]
+
+        for i in range(0, len(items), self.batch_size):
+            pipe = self.client.pipeline(transaction=False)
+            for k, v in items[i:i + self.batch_size]:
+                pipe.setex(self.key(k), self.expires, self.encode(v))
+            pipe.execute()
@@ -0,0 +1,277 @@
+import time
+import random
+import logging
+import threading
+import requests
+import metrics
+
+from email.utils import parsedate_to_datetime
+from tracing import span
+
+#########################################################################
+# Retry policy shared by every request the scrapers make. A request that
+# fails to connect, times out, or gets one of RETRY_STATUSES back is
+# retried after an exponential backoff with full jitter, or after the
+# server's Retry-After if it sent one.
+#
+# Two limits keep retries from making an outage worse:
+#
+# - Each host has a retry budget. Every request adds budget_ratio of a
+#   retry to it and every retry takes a whole one, so retries can't add
+#   more than about budget_ratio to the load on a host however many
+#   requests are failing.
+#
+# - Each host has a circuit breaker. After failure_threshold failures in a
+#   row it opens and requests to the host fail straight away, without
+#   touching the network, for reset_timeout seconds. Then one request is
+#   let through to probe the host; if it succeeds the circuit closes,
+#   otherwise it stays open for another reset_timeout. A request that
+#   finds the circuit open waits for it like it would for a backoff.
+#
+# Every method is retried since the scrapers' POSTs are all searches.
+#########################################################################
+RETRY_STATUSES = (429, 502, 503, 504)
+
+RETRY_EXCEPTIONS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError
+)
+
+logger = logging.getLogger(__name__)
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """ Raised instead of making a request to a host whose circuit is open.
+
+        Initialization components:
+            host (str): the host
+            retry_in (float): seconds until the circuit lets a request
+                through again, or None if another request is probing it
+    """
+    def __init__(self, host, retry_in):
+        super().__init__(f'Circuit for {host} is open')
+        self.host = host
+        self.retry_in = retry_in
+
+class CircuitBreaker(object):
+    """ Stops requests to a host after failure_threshold failures in a row,
+        letting one through every reset_timeout seconds to see if the host
+        has recovered.
+
+        Initialization components:
+            host (str): the host
+            failure_threshold (int): failures in a row that open the circuit
+            reset_timeout (float): seconds the circuit stays open
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, host, failure_threshold=5, reset_timeout=30.0):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0.0
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        '''
+        Raise CircuitOpenError if a request to the host shouldn't be made now
+        '''
+        with self.lock:
+            if self.state == self.CLOSED:
+                return
+
+            retry_in = self.opened + self.reset_timeout - time.monotonic()
+
+            if retry_in > 0:
+                # A probe that takes longer than reset_timeout is given up on
+                raise CircuitOpenError(self.host, retry_in if self.state == self.OPEN else None)
+
+            # Let this request through as the probe and hold the rest back
+            self.state = self.HALF_OPEN
+            self.opened = time.monotonic()
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info(f'Circuit for {self.host} closed')
+                metrics.CIRCUIT_OPEN.set(0, host=self.host)
+
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state == self.CLOSED:
+                    logger.warning(f'Circuit for {self.host} opened after {self.failures} failures')
+                    metrics.CIRCUIT_OPEN.set(1, host=self.host)
+
+                self.state = self.OPEN
+                self.opened = time.monotonic()
+
+class RetryBudget(object):
+    """ Caps retries to a host at about ratio of its requests.
+
+        Initialization components:
+            ratio (float): retries allowed per request
+            max_tokens (float): most retries that can be saved up, which
+                is also what a new budget starts with
+    """
+    def __init__(self, ratio=0.2, max_tokens=10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        '''
+        Take a retry from the budget, returning False if there are none left
+        '''
+        with self.lock:
+            if self.tokens < 1:
+                return False
+
+            self.tokens -= 1
+            return True
+
+def parse_retry_after(value):
+    '''
+    Return the seconds to wait from a Retry-After header, which is either
+    a number of seconds or an HTTP date, or None if it can't be parsed
+    '''
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0.0, when.timestamp() - time.time())
+
+class RetryPolicy(object):
+    """ Retries failed requests with exponential backoff, a retry budget
+        and a circuit breaker per host.
+
+        Initialization components:
+            retries (int): most times a request is retried
+            backoff (float): seconds the first backoff is drawn from, which
+                doubles with each retry
+            max_backoff (float): longest backoff in seconds
+            max_retry_after (float): longest Retry-After that is obeyed;
+                longer ones give up on the request instead
+            statuses (tuple): status codes that are retried
+            budget_ratio (float): retries allowed per request to a host
+            failure_threshold (int): failures in a row that open a circuit
+            reset_timeout (float): seconds a circuit stays open
+    """
+    def __init__(self, retries=5, backoff=0.5, max_backoff=30.0, max_retry_after=300.0,
+                 statuses=RETRY_STATUSES, budget_ratio=0.2, failure_threshold=5,
+                 reset_timeout=30.0):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.statuses = statuses
+        self.budget_ratio = budget_ratio
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers = {}
+        self.budgets = {}
+        self.lock = threading.Lock()
+
+    def get_breaker(self, host):
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(host, self.failure_threshold, self.reset_timeout)
+            return self.breakers[host]
+
+    def get_budget(self, host):
+        with self.lock:
+            if host not in self.budgets:
+                self.budgets[host] = RetryBudget(self.budget_ratio)
+            return self.budgets[host]
+
+    def backoff_time(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def call(self, host, send):
+        '''
+        Return the response from send(), a function making one request to
+        host, retrying it as needed. Once the retries run out the last
+        response is returned, or the last exception raised.
+        '''
+        breaker = self.get_breaker(host)
+        budget = self.get_budget(host)
+        budget.deposit()
+
+        attempt = 0
+
+        while True:
+            resp = error = delay = None
+
+            try:
+                breaker.before_request()
+                resp = send()
+            except CircuitOpenError as e:
+                error, delay, reason = e, e.retry_in, 'circuit_open'
+            except RETRY_EXCEPTIONS as e:
+                breaker.record_failure()
+                error, reason = e, type(e).__name__
+            else:
+                if resp.status_code not in self.statuses:
+                    breaker.record_success()
+                    return resp
+
+                breaker.record_failure()
+                delay, reason = parse_retry_after(resp.headers.get('Retry-After')), str(resp.status_code)
+
+                if delay is not None and delay > self.max_retry_after:
+                    return resp
+
+            # Waiting on an open circuit doesn't load the host so it doesn't
+            # come out of the budget
+            if attempt >= self.retries or (reason != 'circuit_open' and not budget.withdraw()):
+                if error is not None:
+                    raise error
+                return resp
+
+            if delay is None:
+                delay = self.backoff_time(attempt)
+
+            attempt += 1
+
+            logger.debug(f'Retry {attempt}/{self.retries} for {host} in {delay:.2f}s after {reason}')
+            metrics.HTTP_RETRIES.inc(host=host, reason=reason)
+
+            with span('backoff'):
+                time.sleep(delay)
+
+_policy = None
+_policy_lock = threading.Lock()
+
+def get_retry_policy():
+    '''
+    Return the retry policy shared by all scrapers in this process so that
+    they share each host's retry budget and circuit breaker
+    '''
+    global _policy
+
+    with _policy_lock:
+        if _policy is None:
+            _policy = RetryPolicy()
+
+    return _policy
@@ -0,0 +1,134 @@
+import os
+import time
+import logging
+import argparse
+
+from concurrent.futures import ThreadPoolExecutor
+from drhorton import DRHortonScraper
+from pulte import PulteScraper
+from ryanhomes import RyanHomesScraper
+from sheahomes import SheaHomesScraper
+from lennar import LennarScraper
+from metrics import export_metrics
+from tracing import in_context, format_tree, profiling
+
+#########################################################################
+# Runs several builders' scrapers at once in one process. Each scraper
+# spends most of its time waiting on its own site so running them side by
+# side takes about as long as the slowest one rather than the sum of all
+# of them. They share the process-wide rate limiter so the per-host
+# limits hold no matter how many scrapers are running.
+#
+#   $ python runner.py pulte sheahomes --output-dir out
+#########################################################################
+
+# name -> (scraper class, default output file, accepts resume)
+SCRAPERS = {
+    'drhorton': (DRHortonScraper, 'DRHorton.csv', True),
+    'pulte': (PulteScraper, 'pulte.csv', True),
+    'ryanhomes': (RyanHomesScraper, 'ryanhomes.csv', True),
+    'sheahomes': (SheaHomesScraper, 'sheahomes.csv', True),
+    'lennar': (LennarScraper, 'lennar.csv', False)
+}
+
+logger = logging.getLogger(__name__)
+
+def make_scraper(name, output_dir='.', resume=False, base_url=None, format=None):
+    cls, output, accepts_resume = SCRAPERS[name]
+
+    # Every builder is added to the same inventory database
+    if format == 'db':
+        output = 'inventory.db'
+    elif format:
+        output = os.path.splitext(output)[0] + '.' + format
+
+    kwargs = {'output': os.path.join(output_dir, output)}
+    if accepts_resume:
+        kwargs['resume'] = resume
+    if base_url:
+        kwargs['base_url'] = base_url
+
+    return cls(**kwargs)
+
+def run_scraper(name, scraper):
+    '''
+    Run scraper and return a dict with the number of records it wrote
+    and how long it took. Errors are logged and returned rather than
+    raised so one failing builder doesn't stop the others.
+    '''
+    result = {'name': name, 'count': None, 'error': None}
+    start = time.perf_counter()
+
+    try:
+        result['count'] = scraper.scrape()
+    except Exception as e:
+        logger.exception(f'{name} failed')
+        result['error'] = repr(e)
+
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def run_scrapers(scrapers):
+    '''
+    Run the scrapers in the dict of name -> scraper concurrently and
+    return their results along with the total wall time
+    '''
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=len(scrapers)) as executor:
+        futures = [
+            executor.submit(in_context(run_scraper), name, scraper) for name, scraper in scrapers.items()
+        ]
+        results = [f.result() for f in futures]
+
+    return results, time.perf_counter() - start
+
+def report(results, elapsed):
+    lines = [f"{'scraper':12} {'records':>8} {'seconds':>9}"]
+
+    for r in results:
+        count = r['count'] if r['error'] is None else 'failed'
+        lines.append(f"{r['name']:12} {count:>8} {r['seconds']:>9.1f}")
+
+    serial = sum(r['seconds'] for r in results)
+    lines.append(f"{'total':12} {'':>8} {elapsed:>9.1f}")
+    lines.append(f'Run one after another these would have taken about {serial:.1f}s '
+                 f'({serial / elapsed:.1f}x longer)')
+
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scrapers', nargs='*',
+                        help=f"scrapers to run: {', '.join(SCRAPERS)} (default: all)")
+    parser.add_argument('--output-dir', default='.',
+                        help='directory the output files are written to')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue each scraper from where the last run stopped')
+    parser.add_argument('--format', choices=['csv', 'jsonl', 'parquet', 'arrow', 'db'],
+                        help='output format, db adding every builder to inventory.db (default: csv)')
+    parser.add_argument('--base-url',
+                        help='site to scrape for every scraper, e.g. a local mockserver.py')
+    parser.add_argument('--profile', choices=['cprofile', 'sample'],
+                        help='profile the run, saving the results to runner.prof or runner.folded in the output directory')
+    args = parser.parse_args()
+
+    unknown = set(args.scrapers) - set(SCRAPERS)
+    if unknown:
+        parser.error(f"unknown scrapers: {', '.join(sorted(unknown))}")
+
+    FORMAT = "%(asctime)s [ %(filename)s:%(lineno)s - %(funcName)s() ] %(message)s"
+    logging.basicConfig(format=FORMAT, datefmt='%Y-%m-%d %H:%M:%S')
+
+    export_metrics()
+
+    scrapers = {
+        name: make_scraper(name, args.output_dir, args.resume, args.base_url, args.format)
+        for name in args.scrapers or SCRAPERS
+    }
+
+    with profiling(args.profile, os.path.join(args.output_dir, 'runner')):
+        results, elapsed = run_scrapers(scrapers)
+
+    print(report(results, elapsed))
+    print('\nTime per stage:\n' + format_tree())
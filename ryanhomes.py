@@ -1,16 +1,40 @@
 import re
-import csv
-import time
 import json
+import argparse
 import logging
-import requests
 
+from transport import make_session
+from sinks import make_sink
+from records import Home
+from checkpoint import Checkpoint, checkpoint_path
 from urllib.parse import urljoin
-from bs4 import BeautifulSoup
+from parsers import make_soup
+from metrics import timed, export_metrics
+from tracing import span, in_context, format_tree, profiling
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 class RyanHomesScraper(object):
-    def __init__(self):
-        self.url = 'https://www.ryanhomes.com/homelist/search'
+    builder = 'ryanhomes'
+
+    fields = [
+        ('URL', 'url'),
+        ('Address', 'address'),
+        ('Sqft', 'sqft'),
+        ('Price', 'price'),
+        ('Beds', 'bed'),
+        ('Baths', 'bath'),
+        ('Garage', 'car')
+    ]
+
+    def __init__(self, concurrency=4, timeout=30, output='ryanhomes.csv', resume=False,
+                 base_url='https://www.ryanhomes.com'):
+        self.output = output
+        self.resume = resume # continue from the checkpoint of an interrupted run
+        self.checkpoint = None
+        self.concurrency = concurrency # workers loading home pages
+        self.timeout = timeout # seconds per home page request
+        self.url = urljoin(base_url, '/homelist/search')
         self.data = {
             "county":" ",
             "homeType":" ",
@@ -29,34 +53,7 @@ class RyanHomesScraper(object):
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.DEBUG)
 
-        self.session = requests.Session()
-
-    def csv_save(self, data):
-        headers = [
-            'URL',
-            'Address',
-            'Sqft',
-            'Price',
-            'Beds',
-            'Baths',
-            'Garage'
-        ]
-
-        with open('ryanhomes.csv', 'w') as fp:
-            writer = csv.writer(fp, quoting=csv.QUOTE_NONNUMERIC)
-            writer.writerow(headers)
-
-            for d in data:
-                row = [
-                    d.get('url', ''),
-                    d.get('address', ''),
-                    d.get('sqft', ''),
-                    d.get('price', ''),
-                    d.get('bed', ''),
-                    d.get('bath', ''),
-                    d.get('car', '')
-                ]
-                writer.writerow(row)
+        self.session = make_session(pool_size=concurrency)
 
     def gen_listing_url(self, options, item):
         def get_state_name(abbrev):
@@ -85,31 +82,79 @@ class RyanHomesScraper(object):
 
         return urljoin(self.url, url)
 
+    @span('enrich')
     def scrape_home_addr(self, home):
-        resp = self.session.get(home['url'])
-        soup = BeautifulSoup(resp.text, 'html.parser')
+        '''
+        Return a Home for the search result home with the address from
+        its page
+        '''
+        resp = self.session.get(home['url'], timeout=self.timeout)
+        resp.raise_for_status()
+
+        return Home(address=self.parse_home_addr(resp.text), **home)
+
+    @span('parse')
+    @timed('ryanhomes.parse_home_addr')
+    def parse_home_addr(self, html):
+        soup = make_soup(html)
 
         li = soup.select_one('li.header-locDetails')
-        home['address'] = li.text.strip()
+        return li.text.strip()
+
+    def scrape_home_addrs(self, homes, sink=None):
+        '''
+        Load each home's page to get its address using a pool of
+        self.concurrency workers. The Homes are written to sink in
+        order as they complete if one is given. The homes whose page
+        could not be scraped are left out and returned so that they can
+        be retried.
+        '''
+        failed = []
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [
+                executor.submit(in_context(self.scrape_home_addr), home) for home in homes
+            ]
+
+            for i, (home, future) in enumerate(zip(homes, futures), 1):
+                try:
+                    record = future.result()
+                except Exception as e:
+                    self.logger.warning(f"Failed to get address of home at {home['url']}: {e}")
+                    failed.append(home)
+                    continue
+
+                self.logger.info(f"{i}/{len(homes)} Got address of home at {home['url']}")
+
+                if sink:
+                    sink.write(record)
+
+                if sink and self.checkpoint:
+                    sink.after_flush(partial(self.checkpoint.mark_done, 'homes', home['url']))
+
+        return failed
         
+    @span('parse')
+    @timed('ryanhomes.scrape_home_attrs')
     def scrape_home_attrs(self, options, item):
         home = {}
         home['sqft'] = item['squareFootage']
         home['price'] = item['startingPrice']
         home['car'] = item['numberGarageSpaces']
         home['bed'] = item['bedrooms']
-        home['bath'] = str(item['bathrooms'])
-        
+        home['bath'] = item['bathrooms']
+
         if item['halfBath']:
-            home['bath'] += '.5'
+            home['bath'] += 0.5
 
         home['url'] = self.gen_listing_url(options, item)
         return home
 
-    def scrape(self):
+    def search_homes(self):
         homes = []
         
         resp = self.session.post(self.url, json=self.data)
+        resp.raise_for_status()
         data = resp.json()
         
         for item in data['items']:
@@ -117,17 +162,62 @@ class RyanHomesScraper(object):
             homes.append(home)
 
         self.logger.info(f'Scraped {len(homes)} homes')
+        return homes
+
+    #########################################################################
+    # Work units for a distributed crawl (see workqueue.py). Each unit is a
+    # home from the search results which needs its page loaded for the
+    # address.
+    #########################################################################
+    def get_work_units(self):
+        return self.search_homes()
+
+    def process_work_unit(self, home):
+        return [self.scrape_home_addr(home)], []
+
+    @span('ryanhomes.scrape')
+    def scrape(self):
+        self.checkpoint = Checkpoint(checkpoint_path(self.output, self.builder), self.resume)
+
+        with span('discovery'):
+            homes = self.checkpoint.get_work('homes', self.search_homes)
+
+        homes = [
+            h for h in homes if not self.checkpoint.is_done('homes', h['url'])
+        ]
 
         # Unfortunately we have to load each homes page just to
         # get the address...
-        for home in homes:
-            self.logger.info(f"Getting address of home at {home['url']}")
-            self.scrape_home_addr(home)
-            time.sleep(2) # don't hit their servers too quickly...
+        with make_sink(self.output, self.fields, append=self.resume, builder=self.builder) as sink:
+            failed = self.scrape_home_addrs(homes, sink)
+            sink.close(finished=not failed)
+
+        # Keep the checkpoint so --resume can retry the failed homes
+        self.checkpoint.close(finished=not failed)
 
-        self.csv_save(homes)
+        if failed:
+            self.logger.warning(f'Failed to get the address of {len(failed)} / {len(homes)} homes, run with --resume to retry them')
+
+        return sink.count
         
 if __name__ == '__main__':
-    scraper = RyanHomesScraper()
-    scraper.scrape()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default='ryanhomes.csv',
+                        help='output file (.csv or .jsonl, optionally .gz, .parquet, .arrow, or .db to add to an inventory database)')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from where the last run stopped')
+    parser.add_argument('--base-url', default='https://www.ryanhomes.com',
+                        help='site to scrape, e.g. a local mockserver.py')
+    parser.add_argument('--profile', choices=['cprofile', 'sample'],
+                        help='profile the run, saving the results next to the output')
+    args = parser.parse_args()
+
+    export_metrics()
+
+    scraper = RyanHomesScraper(output=args.output, resume=args.resume, base_url=args.base_url)
+
+    with profiling(args.profile, args.output):
+        scraper.scrape()
+
+    scraper.logger.info('Time per stage:\n' + format_tree())
                 
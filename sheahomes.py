@@ -1,16 +1,54 @@
 import re
-import csv
-import time
 import json
+import argparse
 import logging
 import requests
 
+from transport import make_session
+from pipeline import run_stage
+from sinks import make_sink
+from records import Home
+from checkpoint import Checkpoint, checkpoint_path
 from urllib.parse import urljoin
-from bs4 import BeautifulSoup
+from parsers import make_soup, extract_fragment
+from metrics import timed, export_metrics
+from tracing import span, format_tree, profiling
+from itertools import chain
+from functools import partial
 
 class SheaHomesScraper(object):
-    def __init__(self):
-        self.url = 'https://www.sheahomes.com/new-homes/'
+    builder = 'sheahomes'
+
+    fields = [
+        ('URL', 'url'),
+        ('Address', 'address'),
+        ('Sqft', 'sqft'),
+        ('Price', 'price'),
+        ('Stories', 'story'),
+        ('Beds', 'bed'),
+        ('Baths', 'bath'),
+        ('Garage', 'car')
+    ]
+
+    # The parts of a lot page read by scrape_lot_attrs. Only the fragment
+    # of the page spanning these is parsed.
+    lot_targets = [
+        ('about-address', '<div', '</div>'),
+        ('class="large"', '<p', '</p>'),
+        ('alt="Stories Icon"', '<li', '</li>'),
+        ('alt="Bedroom Icon"', '<li', '</li>'),
+        ('alt="Bathroom Icon"', '<li', '</li>'),
+        ('alt="Garage Icon"', '<li', '</li>')
+    ]
+
+    def __init__(self, community_concurrency=2, lot_concurrency=4, output='sheahomes.csv', resume=False,
+                 base_url='https://www.sheahomes.com'):
+        self.output = output
+        self.resume = resume # continue from the checkpoint of an interrupted run
+        self.checkpoint = None
+        self.community_concurrency = community_concurrency # workers loading community pages
+        self.lot_concurrency = lot_concurrency # workers loading lot pages
+        self.url = urljoin(base_url, '/new-homes/')
         self.params = {
             'state': 'any',
             'bedrooms': 'any',
@@ -30,37 +68,7 @@ class SheaHomesScraper(object):
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.DEBUG)
 
-        self.session = requests.Session()
-
-    def csv_save(self, data):
-        headers = [
-            'URL',
-            'Address',
-            'Sqft',
-            'Price',
-            'Stories',
-            'Beds',
-            'Baths',
-            'Garage'
-        ]
-
-        with open('sheahomes.csv', 'w') as fp:
-            writer = csv.writer(fp, quoting=csv.QUOTE_NONNUMERIC)
-            writer.writerow(headers)
-
-            for d in data:
-                row = [
-                    d.get('url', ''),
-                    d.get('address', ''),
-                    d.get('sqft', ''),
-                    d.get('price', ''),
-                    d.get('story', ''),
-                    d.get('bed', ''),
-                    d.get('bath', ''),
-                    d.get('car', '')
-                ]
-                row = [ i for i in row  ]
-                writer.writerow(row)
+        self.session = make_session(pool_size=community_concurrency + lot_concurrency)
 
     def submit_community_aspx(self, url):
         '''
@@ -69,22 +77,15 @@ class SheaHomesScraper(object):
         more homes to load then the AVAILABLE QUICK MOVE-IN HOMES are loaded via 
         an AJAX ASPX POST. 
 
-        We simulate this post and return the HTML from the response
+        We simulate this post and return the parsed HTML from the response
 
         ref: http://toddhayton.com/2015/05/04/scraping-aspnet-pages-with-ajax-pagination/
         '''
-        max_tries = 3
-        num_tries = 0
-
-        while num_tries < max_tries:
-            # Sometimes the server gives us a 502
-            resp = self.session.get(url)
-            if resp.status_code == 200:
-                break
-            num_tries += 1
-            time.sleep(5)
-
-        soup = BeautifulSoup(resp.text, 'html.parser')
+        # Sometimes the server gives us a 502, which the session retries
+        resp = self.session.get(url)
+        resp.raise_for_status()
+
+        soup = make_soup(resp.text)
         form = soup.find('form', id='form')
         data = []
 
@@ -95,7 +96,7 @@ class SheaHomesScraper(object):
 
         i = form.find('input', attrs={'value': 'View More'})
         if not i:
-            return soup.prettify()
+            return soup
 
         # The ID of this div is the same as what gets passed in the manScript form data
         # but with the '_' characters replaced with '$'
@@ -124,25 +125,32 @@ class SheaHomesScraper(object):
 
         url = urljoin(self.url, form['action'])
 
-        num_tries = 0
-        while num_tries < max_tries:
-            resp = self.session.post(url, headers=self.headers, data=data)
-            if resp.status_code == 200:
-                break
+        resp = self.session.post(url, headers=self.headers, data=data)
+        resp.raise_for_status()
 
-            self.logger.warning(f'Post to {url} failed: {resp.status_code} - {resp.reason}')
-            
-            num_tries += 1
-            time.sleep(5)
+        return make_soup(self.get_update_panel(resp.text, update_div['id']))
 
-        it = iter(resp.text.split('|'))
-        kv = dict(zip(it, it))
+    def get_update_panel(self, delta, panel_id):
+        '''
+        Return the HTML for the update panel panel_id from an ASP.NET AJAX
+        delta response. Each entry in the response is length|type|id|content|
+        so we use the length rather than splitting on '|', which can also
+        appear in the content.
+        '''
+        # Looking for something like:
+        # |392405|updatePanel|p_lt_ctl03_pageplaceholder_p_lt_ctl02_FYHSearchResultsFilter_upCommunityListing|
+        r = re.compile(r'(\d+)\|updatePanel\|%s\|' % re.escape(panel_id))
+        m = re.search(r, delta)
+
+        i = m.end()
+        j = m.end() + int(m.group(1))
 
-        return kv[update_div['id']]
+        return delta[i:j]
 
     def submit_quick_moveins_search(self):
         resp = self.session.get(self.url, params=self.params)
-        soup = BeautifulSoup(resp.text, 'html.parser')
+        resp.raise_for_status()
+        soup = make_soup(resp.text)
 
         form = soup.find('form', id='form')
         data = []
@@ -178,20 +186,14 @@ class SheaHomesScraper(object):
 
         url = urljoin(self.url, form['action'])
         resp = self.session.post(url, headers=self.headers, data=data)
+        resp.raise_for_status()
 
-        # Looking for something like:
-        # |392405|updatePanel|p_lt_ctl03_pageplaceholder_p_lt_ctl02_FYHSearchResultsFilter_upCommunityListing|
-        r = re.compile(r'\|(\d+)\|updatePanel\|%s\|' % update_div['id'])
-        m = re.search(r, resp.text)
-
-        i = m.end()
-        j = m.end() + int(m.group(1))
-
-        return resp.text[i:j]
+        return self.get_update_panel(resp.text, update_div['id'])
 
+    @span('discovery')
     def get_community_links(self):
         html = self.submit_quick_moveins_search()
-        soup = BeautifulSoup(html, 'html.parser')
+        soup = make_soup(html)
         urls = []
 
         for a in soup.select('a.card-community'):
@@ -201,45 +203,142 @@ class SheaHomesScraper(object):
         self.logger.info(f'Returning {len(urls)} move in ready communities')
         return urls
 
-    def scrape(self):
-        lots = []
-        urls = self.get_community_links()
-        
-        for url in urls:
-            self.logger.info(f'Getting movein ready homes at {url}')
+    @span('discovery')
+    def get_lot_urls(self, url):
+        '''
+        Return the URLs of the movein ready lots in the community at url,
+        or None if the community page couldn't be loaded
+        '''
+        self.logger.info(f'Getting movein ready homes at {url}')
 
-            html = self.submit_community_aspx(url)
-            if html is None:
-                self.logger.warning(f'Skipping community at {url}')
-                continue
+        soup = self.submit_community_aspx(url)
+        if soup is None:
+            self.logger.warning(f'Skipping community at {url}')
+            return None
+
+        divs = soup.select('section#qmi-homes div.card-content')
 
-            soup = BeautifulSoup(html, 'html.parser')
-            divs = soup.select('section#qmi-homes div.card-content')
+        self.logger.info(f'{len(divs)} movein ready homes at {url}')
 
-            self.logger.info(f'{len(divs)} movein ready homes')
+        return [
+            urljoin(self.url, d.a['href']) for d in divs
+        ]
 
-            for d in divs:
-                lot = {}
-                lot['url'] = urljoin(self.url, d.a['href'])
+    def get_lot(self, url):
+        return [Home(url=url, **self.scrape_lot(url))]
 
-                data = self.scrape_lot(lot['url'])
-                if data is not None:
-                    lot.update(data)
-                    lots.append(lot)
+    def checkpoint_lot(self, url):
+        '''
+        Return the lot at url in a list, or an empty list if it can't be
+        loaded or parsed, in which case it is left pending in the
+        checkpoint so --resume tries it again
+        '''
+        try:
+            return self.get_lot(url)
+        except (requests.exceptions.RequestException, AttributeError, TypeError) as e:
+            self.logger.warning(f'Failed to get lot at {url}: {e}')
+            self.failed.append(url)
+            return []
+
+    def checkpoint_lot_urls(self, url):
+        '''
+        Return the lot URLs for the community at url after logging them
+        to the checkpoint. A community that can't be loaded or parsed is
+        left out of the checkpoint so --resume tries it again.
+        '''
+        try:
+            lot_urls = self.get_lot_urls(url)
+        except (requests.exceptions.RequestException, AttributeError, TypeError) as e:
+            self.logger.warning(f'Failed to load community at {url}: {e}')
+            lot_urls = None
 
-        self.csv_save(lots)
+        if lot_urls is None:
+            self.failed.append(url)
+            return []
+
+        self.checkpoint.add_work('lots', lot_urls)
+        self.checkpoint.mark_done('communities', url)
+        return lot_urls
+
+    def iter_lots(self):
+        '''
+        Yield lots as soon as they are scraped. Community pages are loaded by
+        a pool of community workers which feed lot URLs to a separate pool of
+        lot workers, so lots from different communities are loaded at once.
+
+        On resume the lots found by the last run that weren't finished are
+        loaded first and only the remaining communities are loaded again.
+        '''
+        urls = self.checkpoint.get_work('communities', self.get_community_links)
+        urls = self.checkpoint.pending('communities', urls)
+
+        pending_lot_urls = self.checkpoint.pending('lots', self.checkpoint.work.get('lots', []))
+
+        lot_urls = chain(
+            pending_lot_urls,
+            run_stage(self.checkpoint_lot_urls, urls, self.community_concurrency)
+        )
+        return run_stage(self.checkpoint_lot, lot_urls, self.lot_concurrency)
+
+    #########################################################################
+    # Work units for a distributed crawl (see workqueue.py). Each unit is a
+    # community URL and its lots are loaded by self.lot_concurrency workers.
+    #########################################################################
+    def get_work_units(self):
+        return self.get_community_links()
+
+    def process_work_unit(self, url):
+        lot_urls = self.get_lot_urls(url)
+        if lot_urls is None:
+            raise RuntimeError(f'Failed to load community at {url}')
+
+        return list(run_stage(self.get_lot, lot_urls, self.lot_concurrency)), []
+
+    @span('sheahomes.scrape')
+    def scrape(self):
+        self.checkpoint = Checkpoint(checkpoint_path(self.output, self.builder), self.resume)
+        self.failed = []
+
+        with make_sink(self.output, self.fields, append=self.resume, builder=self.builder) as sink:
+            for lot in self.iter_lots():
+                sink.write(lot)
+                sink.after_flush(partial(self.checkpoint.mark_done, 'lots', lot.url))
+
+            sink.close(finished=not self.failed)
+
+        # Keep the checkpoint so --resume can retry the failed communities and lots
+        self.checkpoint.close(finished=not self.failed)
+
+        if self.failed:
+            self.logger.warning(f'Failed to load {len(self.failed)} communities and lots, run with --resume to retry them')
+
+        self.logger.info(f'Scraped {sink.count} lots')
+        return sink.count
         
     def scrape_lot(self, url):
-        lot = {}
-
         self.logger.info(f'Getting info for lot at {url}')
 
         resp = self.session.get(url)
-        if resp.status_code != 200:
-            self.logger.warning(f'Request to {url} failed: {resp.status_code} - {resp.reason}')
-            return None
+        resp.raise_for_status()
+
+        return self.parse_lot(resp.text)
+
+    @span('parse')
+    @timed('sheahomes.parse_lot')
+    def parse_lot(self, html):
+        fragment = extract_fragment(html, self.lot_targets)
 
-        soup = BeautifulSoup(resp.text, 'html.parser')
+        # Fall back to the whole page if it isn't laid out as expected
+        if fragment is not html:
+            try:
+                return self.scrape_lot_attrs(make_soup(fragment))
+            except (AttributeError, TypeError) as e:
+                self.logger.debug(f'Parsing the whole lot page, the fragment failed: {e!r}')
+
+        return self.scrape_lot_attrs(make_soup(html))
+
+    def scrape_lot_attrs(self, soup):
+        lot = {}
 
         addr = soup.select_one('div.about-address')
         addr.select_one('p.address-label').extract()
@@ -281,5 +380,22 @@ class SheaHomesScraper(object):
         return lot
     
 if __name__ == '__main__':
-    scraper = SheaHomesScraper()
-    scraper.scrape()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default='sheahomes.csv',
+                        help='output file (.csv or .jsonl, optionally .gz, .parquet, .arrow, or .db to add to an inventory database)')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from where the last run stopped')
+    parser.add_argument('--base-url', default='https://www.sheahomes.com',
+                        help='site to scrape, e.g. a local mockserver.py')
+    parser.add_argument('--profile', choices=['cprofile', 'sample'],
+                        help='profile the run, saving the results next to the output')
+    args = parser.parse_args()
+
+    export_metrics()
+
+    scraper = SheaHomesScraper(output=args.output, resume=args.resume, base_url=args.base_url)
+
+    with profiling(args.profile, args.output):
+        scraper.scrape()
+
+    scraper.logger.info('Time per stage:\n' + format_tree())
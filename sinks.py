@@ -0,0 +1,339 @@
+import os
+import csv
+import gzip
+import json
+import time
+import threading
+import metrics
+
+from tracing import span
+from records import json_default, NUMERIC_FIELDS, SHARED_FIELDS
+from inventory import Inventory
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+class Sink(object):
+    """ Writes records to a file one at a time as they are scraped.
+
+        Writes go through a buffered file which is flushed every
+        flush_every records or flush_interval seconds, whichever comes
+        first, so at most that much output is lost if a run dies.
+
+        Initialization components:
+            path (str): output file, gzip compressed if it ends in .gz
+            fields (list): (header, key) pairs giving the columns to write
+                and the record key for each one
+            append (bool): add to an existing file instead of overwriting it
+            flush_every (int): records written between flushes
+            flush_interval (float): seconds between flushes
+    """
+    def __init__(self, path, fields, append=False, flush_every=100, flush_interval=5.0):
+        self.path = path
+        self.fields = fields
+        self.append = append
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+
+        self.count = 0
+        self.fp = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        empty = not (self.append and os.path.exists(self.path) and os.path.getsize(self.path) > 0)
+
+        mode = 'a' if self.append else 'w'
+        if self.path.endswith('.gz'):
+            self.fp = gzip.open(self.path, mode + 't', newline='')
+        else:
+            self.fp = open(self.path, mode, newline='', buffering=1 << 16)
+
+        self.unflushed = 0
+        self.last_flush = self.opened = time.monotonic()
+
+        self.open_writer()
+        if empty:
+            self.write_header()
+
+    def open_writer(self):
+        pass
+
+    def write_header(self):
+        pass
+
+    def write_record(self, record):
+        raise NotImplementedError
+
+    @span('save')
+    def write(self, record):
+        with self.lock:
+            self.write_record(record)
+            self.count += 1
+            self.unflushed += 1
+            metrics.RECORDS.inc(output=os.path.basename(self.path))
+
+            if self.unflushed >= self.flush_every or \
+               time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush()
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        self.fp.flush()
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+
+        elapsed = self.last_flush - self.opened
+        if elapsed > 0:
+            metrics.RECORDS_PER_SECOND.set(self.count / elapsed, output=os.path.basename(self.path))
+
+    def after_flush(self, fn):
+        '''
+        Call fn once every record written so far is flushed, e.g. to mark
+        the unit of work they came from done in a checkpoint
+        '''
+        with self.lock:
+            self.flush()
+            fn()
+
+    def close(self, finished=True):
+        '''
+        Flush and close the output. finished is False if the scrape
+        stopped part way or left work to retry; closing again does nothing.
+        '''
+        if self.fp:
+            self.flush()
+            self.fp.close()
+            self.fp = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(finished=exc_type is None)
+
+class CsvSink(Sink):
+    def open_writer(self):
+        self.writer = csv.writer(self.fp, quoting=csv.QUOTE_NONNUMERIC)
+
+    def write_header(self):
+        self.writer.writerow([header for header, key in self.fields])
+
+    def write_record(self, record):
+        self.writer.writerow([
+            record.get(key, '') for header, key in self.fields
+        ])
+
+class JsonLinesSink(Sink):
+    def write_record(self, record):
+        self.fp.write(json.dumps(record, default=json_default) + '\n')
+
+#########################################################################
+# Columnar output for analytics. Records are buffered and written a row
+# group (Parquet) or record batch (Arrow IPC) at a time, with numbers in
+# typed columns and repeated strings dictionary encoded. Both need the
+# optional pyarrow package.
+#
+# Neither format can be appended to and a file is only readable once its
+# footer is written when the sink is closed, so these can't be used to
+# resume a run.
+#########################################################################
+
+# Columns written in addition to the scraper's fields
+EXTRA_COLUMNS = [('State', 'state')]
+
+DICTIONARY_COLUMNS = SHARED_FIELDS + ('state',)
+
+def column_type(key):
+    if key in NUMERIC_FIELDS:
+        return pa.int32() if NUMERIC_FIELDS[key][0] is int else pa.float32()
+    if key in DICTIONARY_COLUMNS:
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+class ColumnarSink(Sink):
+    """ Writes records to a columnar file row_group_size records at a time.
+
+        Initialization components:
+            path (str): output file
+            fields (list): (header, key) pairs giving the columns to write
+                and the record key for each one
+            row_group_size (int): records in each row group or batch
+            compression (str): codec for the column data
+    """
+    def __init__(self, path, fields, row_group_size=10000, compression='zstd', **kwargs):
+        if pa is None:
+            raise ImportError(f'pyarrow is needed to write {path}')
+
+        super().__init__(path, fields, **kwargs)
+        self.row_group_size = row_group_size
+        self.compression = compression
+
+        self.columns = [key for header, key in fields + EXTRA_COLUMNS]
+        self.schema = pa.schema([(key, column_type(key)) for key in self.columns])
+
+    def open(self):
+        if self.append and os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            raise ValueError(f"Can't append to {self.path}, write to a new file instead")
+
+        self.fp = open(self.path, 'wb')
+
+        self.unflushed = 0
+        self.last_flush = self.opened = time.monotonic()
+
+        self.buffer = {key: [] for key in self.columns}
+
+        # Every batch uses the dictionaries built so far, which only ever
+        # grow, so an Arrow IPC file can carry them as deltas
+        self.dictionaries = {key: {} for key in self.columns if key in DICTIONARY_COLUMNS}
+
+        self.open_writer()
+
+    def write_record(self, record):
+        for key in self.columns:
+            self.buffer[key].append(record.get(key))
+
+        if len(self.buffer[self.columns[0]]) >= self.row_group_size:
+            self.write_batch()
+
+    def make_array(self, key, values):
+        if key not in self.dictionaries:
+            return pa.array(values, type=self.schema.field(key).type)
+
+        index = self.dictionaries[key]
+        indices = [
+            None if v is None else index.setdefault(v, len(index)) for v in values
+        ]
+
+        return pa.DictionaryArray.from_arrays(
+            pa.array(indices, type=pa.int32()), pa.array(list(index), type=pa.string())
+        )
+
+    def write_batch(self):
+        if not self.buffer[self.columns[0]]:
+            return
+
+        batch = pa.RecordBatch.from_arrays(
+            [self.make_array(key, self.buffer[key]) for key in self.columns], schema=self.schema
+        )
+        self.writer.write_batch(batch)
+
+        for values in self.buffer.values():
+            values.clear()
+
+    def close(self, finished=True):
+        if self.fp:
+            self.write_batch()
+            self.writer.close()
+        super().close(finished)
+
+class ParquetSink(ColumnarSink):
+    def open_writer(self):
+        self.writer = pq.ParquetWriter(self.fp, self.schema, compression=self.compression)
+
+class ArrowSink(ColumnarSink):
+    def open_writer(self):
+        options = pa.ipc.IpcWriteOptions(compression=self.compression, emit_dictionary_deltas=True)
+        self.writer = pa.ipc.new_file(self.fp, self.schema, options=options)
+
+class InventorySink(Sink):
+    """ Upserts records into an Inventory database (see inventory.py) in
+        transactions of up to batch_size records, recording the run that
+        saw them. The database is added to, never overwritten; append
+        carries on the builder's unfinished run instead of starting one.
+
+        Initialization components:
+            path (str): inventory database
+            fields (list): (header, key) pairs, unused as every Home
+                field is stored
+            builder (str): name of the builder the records are from
+            batch_size (int): most records upserted in one transaction,
+                which is also how often they're flushed by default
+    """
+    def __init__(self, path, fields, builder=None, batch_size=500, **kwargs):
+        if builder is None:
+            raise ValueError(f'A builder is needed to write to {path}')
+
+        # Each flush commits a transaction, which costs far more than
+        # flushing a file
+        kwargs.setdefault('flush_every', batch_size)
+
+        super().__init__(path, fields, **kwargs)
+        self.builder = builder
+        self.batch_size = batch_size
+
+    def open(self):
+        self.inventory = Inventory(self.path)
+        self.run_id, self.started = self.inventory.start_run(self.builder, self.append)
+        self.pending = []
+        self.callbacks = []
+
+        self.fp = self.inventory
+        self.unflushed = 0
+        self.last_flush = self.opened = time.monotonic()
+
+    def write_record(self, record):
+        self.pending.append(record)
+
+        if len(self.pending) >= self.batch_size:
+            self.write_batch()
+
+    def write_batch(self):
+        if self.pending:
+            self.inventory.upsert_many(self.builder, self.run_id, self.started, self.pending)
+            self.pending = []
+
+        callbacks, self.callbacks = self.callbacks, []
+        for fn in callbacks:
+            fn()
+
+    def after_flush(self, fn):
+        # Committing a transaction per unit of work would undo the
+        # batching, so fn waits for the batch its records are in
+        with self.lock:
+            self.callbacks.append(fn)
+            if not self.pending:
+                self.write_batch()
+
+    def flush(self):
+        self.write_batch()
+        super().flush()
+
+    def close(self, finished=True):
+        if self.fp:
+            self.write_batch()
+
+            # A run that stopped part way or failed some of its work isn't
+            # marked finished, so the homes it didn't see aren't reported
+            # as gone and --resume carries it on
+            if finished:
+                self.inventory.finish_run(self.run_id)
+        super().close(finished)
+
+def make_sink(path, fields, **kwargs):
+    '''
+    Return a sink for path based on its extension: .csv or .jsonl,
+    optionally followed by .gz, .parquet, .arrow, or .db for an Inventory
+    database. Only InventorySink uses the builder keyword argument.
+    '''
+    if path.endswith('.db'):
+        return InventorySink(path, fields, **kwargs)
+
+    kwargs.pop('builder', None)
+
+    if path.endswith('.parquet'):
+        return ParquetSink(path, fields, **kwargs)
+    if path.endswith('.arrow'):
+        return ArrowSink(path, fields, **kwargs)
+
+    name = path[:-len('.gz')] if path.endswith('.gz') else path
+
+    if name.endswith('.jsonl'):
+        return JsonLinesSink(path, fields, **kwargs)
+    return CsvSink(path, fields, **kwargs)
@@ -0,0 +1,132 @@
+import time
+import zlib
+import sqlite3
+import threading
+import metrics
+
+from datetime import timedelta
+
+class SqliteCache:
+    """ File backed cache with the same interface as RedisCache for runs
+        without a Redis server. The database is opened in WAL mode so any
+        number of threads or processes can read while one writes.
+
+        Initialization components:
+            path (str): path of the SQLite database file
+            encoding (str): character encoding for serialization
+            compress (bool): boolean indicating whether compression with zlib should be used
+            namespace (str): prefix for the keys of this cache so that several
+                caches can share a database
+            expires (timedelta): how long values in this namespace are kept
+            batch_size (int): most keys read in one query by get_many
+    """
+    def __init__(self, path='cache.db', encoding='utf-8', compress=False,
+                 namespace=None, expires=timedelta(days=2), batch_size=500):
+        self.path = path
+        self.encoding = encoding
+        self.compress = compress
+        self.namespace = namespace
+        self.expires = expires
+        self.batch_size = batch_size
+        self.local = threading.local()
+
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache '
+                '(key TEXT PRIMARY KEY, value BLOB, expires REAL)'
+            )
+        self.purge()
+
+    @property
+    def conn(self):
+        """SQLite connections can't be shared between threads so each
+        thread gets its own"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    @property
+    def name(self):
+        return f"sqlite:{self.namespace or 'default'}"
+
+    def key(self, key):
+        return f'{self.namespace}:{key}' if self.namespace else key
+
+    def decode(self, record):
+        if self.compress:
+            record = zlib.decompress(record)
+        return record.decode(self.encoding)
+
+    def encode(self, val):
+        data = val.encode(self.encoding)
+        if self.compress:
+            data = zlib.compress(data)
+        return data
+
+    def __getitem__(self, key):
+        """Load data from SQLite for given key"""
+        row = self.conn.execute(
+            'SELECT value FROM cache WHERE key = ? AND expires > ?',
+            (self.key(key), time.time())
+        ).fetchone()
+
+        if row:
+            metrics.CACHE_REQUESTS.inc(cache=self.name, result='hit')
+            return self.decode(row[0])
+        else:
+            metrics.CACHE_REQUESTS.inc(cache=self.name, result='miss')
+            raise KeyError(key + ' does not exist')
+
+    def __setitem__(self, key, val):
+        """Save value to SQLite for given key"""
+        if not key or not val:
+            return
+
+        self.set_many({key: val})
+
+    def get_many(self, keys):
+        """Load data from SQLite for all of keys. Returns a dict with the
+        keys that were found."""
+        keys = list(keys)
+        found = {}
+        now = time.time()
+
+        for i in range(0, len(keys), self.batch_size):
+            batch = {self.key(k): k for k in keys[i:i + self.batch_size]}
+            marks = ','.join('?' * len(batch))
+
+            rows = self.conn.execute(
+                f'SELECT key, value FROM cache WHERE key IN ({marks}) AND expires > ?',
+                list(batch) + [now]
+            )
+
+            for k, value in rows:
+                found[batch[k]] = self.decode(value)
+
+        metrics.CACHE_REQUESTS.inc(len(found), cache=self.name, result='hit')
+        metrics.CACHE_REQUESTS.inc(len(keys) - len(found), cache=self.name, result='miss')
+        return found
+
+    def set_many(self, mapping):
+        """Save all of the key/value pairs in mapping to SQLite in one
+        transaction"""
+        expires = time.time() + self.expires.total_seconds()
+        rows = [
+            (self.key(k), self.encode(v), expires)
+            for k, v in mapping.items() if k and v
+        ]
+
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                rows
+            )
+
+    def purge(self):
+        """Delete expired values"""
+        with self.conn:
+            self.conn.execute('DELETE FROM cache WHERE expires <= ?', (time.time(),))
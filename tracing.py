@@ -0,0 +1,210 @@
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import functools
+import contextvars
+
+from contextlib import contextmanager
+
+#########################################################################
+# Timing spans for the stages of a scrape (discovery, fetch, parse,
+# enrich, save). Spans nest, so each run builds a tree of how many times
+# each stage ran and how long it took in total:
+#
+#   drhorton.scrape        1    61.20s
+#     discovery            1     0.84s
+#     fetch              812    58.10s
+#       ratelimit        812    40.02s
+#     parse              812     1.91s
+#     save              6496     0.12s
+#
+# The current span is kept in a context variable so that spans opened on
+# worker threads and asyncio tasks are placed under the span that started
+# them. Work submitted to a thread pool has to be wrapped with
+# in_context() for that to happen. Times are summed over every thread so a
+# stage done by several workers at once can add up to more than the run.
+#########################################################################
+_current = contextvars.ContextVar('span', default=())
+
+_totals = {}
+_lock = threading.Lock()
+
+@contextmanager
+def _span(name):
+    path = _current.get() + (name,)
+    token = _current.set(path)
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        _current.reset(token)
+
+        with _lock:
+            count, total = _totals.get(path, (0, 0.0))
+            _totals[path] = (count + 1, total + elapsed)
+
+class span(object):
+    """ Time a block of code or every call to a function as a stage of
+        the current span. Usable as a context manager or a decorator.
+
+        Initialization components:
+            name (str): name of the stage
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.cm = _span(self.name)
+        return self.cm.__enter__()
+
+    def __exit__(self, *exc):
+        return self.cm.__exit__(*exc)
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _span(self.name):
+                return func(*args, **kwargs)
+        return wrapper
+
+def in_context(func):
+    '''
+    Return func bound to a copy of the current context so that spans it
+    opens on another thread are placed under the current span
+    '''
+    return functools.partial(contextvars.copy_context().run, func)
+
+def get_tree(root=None):
+    '''
+    Return (path, count, seconds) for every span under root, or every span
+    if root is None, with children listed after their parents
+    '''
+    with _lock:
+        items = list(_totals.items())
+
+    return [
+        (path, count, total) for path, (count, total) in sorted(items)
+        if root is None or path[:1] == (root,)
+    ]
+
+def format_tree(root=None):
+    lines = []
+
+    for path, count, total in get_tree(root):
+        name = '  ' * (len(path) - 1) + path[-1]
+        lines.append(f'{name:30} {count:>8} {total:>9.2f}s')
+
+    return '\n'.join(lines)
+
+def reset():
+    with _lock:
+        _totals.clear()
+
+#########################################################################
+# Profiling. Both profilers cover every thread: cProfile is started on
+# each new thread as well as the current one, and the sampler reads the
+# stack of every thread every interval seconds. Neither costs anything
+# unless a run asks for it.
+#########################################################################
+class CProfiler(object):
+    """ Deterministic profile of the current thread and every thread
+        started while it runs, saved as pstats data to path + '.prof'.
+    """
+    suffix = '.prof'
+
+    def __init__(self, path):
+        self.path = path + self.suffix
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def start_thread(self, frame, event, arg):
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def start(self):
+        threading.setprofile(self.start_thread)
+        self.profile = cProfile.Profile()
+        self.profiles.append(self.profile)
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        threading.setprofile(None)
+
+        with self.lock:
+            stats = pstats.Stats(*self.profiles)
+        stats.dump_stats(self.path)
+
+class SamplingProfiler(threading.Thread):
+    """ Statistical profile of every thread, saved to path + '.folded' in
+        the collapsed stack format read by flamegraph.pl and speedscope.
+
+        Initialization components:
+            path (str): output path without the suffix
+            interval (float): seconds between samples
+    """
+    suffix = '.folded'
+
+    def __init__(self, path, interval=0.005):
+        super().__init__(daemon=True)
+        self.path = path + self.suffix
+        self.interval = interval
+        self.stacks = {}
+        self.stopped = threading.Event()
+
+    def sample(self):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == self.ident:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+
+            key = ';'.join(reversed(stack))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+        with open(self.path, 'w') as fp:
+            for stack, count in sorted(self.stacks.items()):
+                fp.write(f'{stack} {count}\n')
+
+PROFILERS = {
+    'cprofile': CProfiler,
+    'sample': SamplingProfiler
+}
+
+@contextmanager
+def profiling(mode, path):
+    '''
+    Profile the block with the profiler named mode ('cprofile' or 'sample')
+    and save the results next to path. Does nothing if mode is None.
+    '''
+    if mode is None:
+        yield
+        return
+
+    profiler = PROFILERS[mode](path)
+    profiler.start()
+
+    try:
+        yield
+    finally:
+        profiler.stop()
@@ -0,0 +1,91 @@
+import metrics
+
+from ratelimit import RateLimitedSession
+from httpcache import CachingAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool, port_by_scheme
+from urllib3.util.request import ACCEPT_ENCODING
+
+#########################################################################
+# HTTP transport shared by the scrapers. make_session() returns a session
+# that:
+#
+# - keeps up to pool_size connections open to each host so that every one
+#   of a scraper's workers can reuse a connection instead of opening a
+#   new one, with its DNS lookup and TLS handshake, for each request;
+# - asks for gzip or deflate compressed responses (the encodings urllib3
+#   can decode, which with the pinned urllib3 doesn't include br);
+# - gives up on a request that can't connect within CONNECT_TIMEOUT
+#   seconds or stalls for READ_TIMEOUT seconds, leaving it to the retry
+#   policy to try again.
+#
+# The pools count the connections they open, reuse and throw away because
+# they're full, so the metrics show whether pool_size is big enough.
+#########################################################################
+
+# Seconds
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+DEFAULT_POOL_SIZE = 10
+
+class CountingPoolMixin(object):
+    '''
+    Connection pool that counts the connections it opens, reuses and
+    discards
+    '''
+    @property
+    def host_label(self):
+        if self.port is None or self.port == port_by_scheme.get(self.scheme):
+            return self.host
+        return f'{self.host}:{self.port}'
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+
+        # A connection that has been used before is still connected
+        result = 'new' if getattr(conn, 'sock', None) is None else 'reused'
+        metrics.HTTP_CONNECTIONS.inc(host=self.host_label, result=result)
+
+        return conn
+
+    def _put_conn(self, conn):
+        if self.pool is not None and self.pool.full():
+            metrics.HTTP_CONNECTIONS_DISCARDED.inc(host=self.host_label)
+
+        super()._put_conn(conn)
+
+class CountingHTTPConnectionPool(CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+class CountingHTTPSConnectionPool(CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+POOL_CLASSES = {
+    'http': CountingHTTPConnectionPool,
+    'https': CountingHTTPSConnectionPool
+}
+
+class TransportAdapter(CachingAdapter):
+    """ CachingAdapter whose connection pools count how often connections
+        are reused. Takes the same arguments as CachingAdapter and
+        HTTPAdapter.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = POOL_CLASSES
+
+def make_session(pool_size=DEFAULT_POOL_SIZE, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), cache=None):
+    '''
+    Return a rate limited, retrying session that caches responses if an
+    HTTP cache is configured (see get_http_cache()) and keeps up to
+    pool_size connections open to each host. pool_size should be at least
+    the number of requests the scraper makes at once.
+    '''
+    session = RateLimitedSession(timeout=timeout)
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+
+    adapter = TransportAdapter(cache, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
@@ -0,0 +1,426 @@
+import os
+import copy
+import json
+import time
+import uuid
+import logging
+import argparse
+import threading
+
+from functools import partial
+from redis import StrictRedis
+from records import Home, json_default
+
+#########################################################################
+# Distributed crawl. A coordinator discovers a scraper's work units
+# (DRHorton community IDs, Pulte state/page pairs, Shea community URLs,
+# Ryan Homes homes) and puts them on a queue in Redis. Any number of
+# workers on any number of machines lease units from the queue, scrape
+# them and ack them along with their records, which the coordinator
+# writes to a single output file.
+#
+# A leased unit is hidden from other workers until its lease times out.
+# Workers renew their leases while they work, so if a worker dies its
+# units go back on the queue once their lease expires. An ack is only
+# accepted from the worker currently holding the lease so a unit's
+# records are never written twice.
+#
+# The coordinator moves each result to a processing list while it writes
+# it and only deletes it once the output is flushed. A coordinator that
+# picks up a running queue appends to the output and first puts any
+# results left in processing back, so none are lost if it dies, although
+# the records of one written just before it died may be written again.
+#
+#   $ python workqueue.py coordinate pulte --output pulte.csv
+#   $ python workqueue.py work pulte --workers 4      # on each node
+#########################################################################
+
+# Scripts that read TIME call redis.replicate_commands() first so that
+# Redis before 5 lets them write afterwards.
+
+# Take the next unit off the queue, first returning units whose lease has
+# expired. Units that keep failing are moved to the failed set instead.
+LEASE_SCRIPT = '''
+if redis.replicate_commands then redis.replicate_commands() end
+
+local pending, leased, owners, attempts, failed = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+local token = ARGV[1]
+local timeout = tonumber(ARGV[2])
+local max_attempts = tonumber(ARGV[3])
+
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+
+for _, unit in ipairs(redis.call('ZRANGEBYSCORE', leased, '-inf', now)) do
+    redis.call('ZREM', leased, unit)
+    redis.call('HDEL', owners, unit)
+    redis.call('LPUSH', pending, unit)
+end
+
+while true do
+    local unit = redis.call('LPOP', pending)
+    if not unit then
+        return nil
+    end
+
+    if redis.call('HINCRBY', attempts, unit, 1) <= max_attempts then
+        redis.call('ZADD', leased, now + timeout, unit)
+        redis.call('HSET', owners, unit, token)
+        return unit
+    end
+
+    redis.call('HDEL', attempts, unit)
+    redis.call('SADD', failed, unit)
+end
+'''
+
+# Renew a lease if it is still held by token
+EXTEND_SCRIPT = '''
+if redis.replicate_commands then redis.replicate_commands() end
+
+local leased, owners = KEYS[1], KEYS[2]
+local unit, token, timeout = ARGV[1], ARGV[2], tonumber(ARGV[3])
+
+if redis.call('HGET', owners, unit) ~= token then
+    return 0
+end
+
+local t = redis.call('TIME')
+redis.call('ZADD', leased, tonumber(t[1]) + tonumber(t[2]) / 1000000 + timeout, unit)
+return 1
+'''
+
+# Finish a unit if it is still held by token, saving its result and
+# queueing any units found while working on it. Results are pushed on the
+# left and popped from the right so they're read in the order they came.
+ACK_SCRIPT = '''
+local leased, owners, attempts, pending, results = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+local unit, token, result = ARGV[1], ARGV[2], ARGV[3]
+
+if redis.call('HGET', owners, unit) ~= token then
+    return 0
+end
+
+redis.call('ZREM', leased, unit)
+redis.call('HDEL', owners, unit)
+redis.call('HDEL', attempts, unit)
+redis.call('LPUSH', results, result)
+
+for i = 4, #ARGV do
+    redis.call('RPUSH', pending, ARGV[i])
+end
+return 1
+'''
+
+# Give a unit back to the queue if it is still held by token
+RELEASE_SCRIPT = '''
+local leased, owners, pending = KEYS[1], KEYS[2], KEYS[3]
+local unit, token = ARGV[1], ARGV[2]
+
+if redis.call('HGET', owners, unit) ~= token then
+    return 0
+end
+
+redis.call('ZREM', leased, unit)
+redis.call('HDEL', owners, unit)
+redis.call('RPUSH', pending, unit)
+return 1
+'''
+
+logger = logging.getLogger(__name__)
+
+class WorkQueue(object):
+    """ Queue of work units in Redis that workers lease with a visibility
+        timeout. Units are any JSON serializable value.
+
+        Initialization components:
+            client: a Redis client
+            name (str): name of the queue, usually the scraper's name
+            lease_timeout (float): seconds a unit stays leased without
+                being renewed before it's given to another worker
+            max_attempts (int): times a unit is leased before it's given up on
+            prefix (str): prefix for the queue's keys
+    """
+    def __init__(self, client, name, lease_timeout=300, max_attempts=5, prefix='workqueue'):
+        self.client = client
+        self.name = name
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+
+        key = lambda k: f'{prefix}:{name}:{k}'
+        self.state_key = key('state')
+        self.pending_key = key('pending')
+        self.leased_key = key('leased')
+        self.owners_key = key('owners')
+        self.attempts_key = key('attempts')
+        self.failed_key = key('failed')
+        self.results_key = key('results')
+        self.processing_key = key('processing')
+
+        self.lease_script = client.register_script(LEASE_SCRIPT)
+        self.extend_script = client.register_script(EXTEND_SCRIPT)
+        self.ack_script = client.register_script(ACK_SCRIPT)
+        self.release_script = client.register_script(RELEASE_SCRIPT)
+
+    def encode(self, unit):
+        return json.dumps(unit, sort_keys=True)
+
+    def decode(self, value):
+        return json.loads(value)
+
+    def state(self):
+        '''
+        Return 'running', 'finished' or None if the queue was never started
+        '''
+        state = self.client.get(self.state_key)
+        return state.decode('utf-8') if state else None
+
+    def start(self, units):
+        '''
+        Replace anything left in the queue with units
+        '''
+        self.clear()
+
+        pipe = self.client.pipeline()
+        for i in range(0, len(units), 500):
+            pipe.rpush(self.pending_key, *[self.encode(u) for u in units[i:i + 500]])
+        pipe.set(self.state_key, 'running')
+        pipe.execute()
+
+    def finish(self):
+        '''
+        Mark the queue finished so that idle workers exit. The marker is
+        kept for a day.
+        '''
+        self.clear()
+        self.client.set(self.state_key, 'finished', ex=24 * 60 * 60)
+
+    def clear(self):
+        self.client.delete(self.state_key, self.pending_key, self.leased_key, self.owners_key,
+                           self.attempts_key, self.failed_key, self.results_key,
+                           self.processing_key)
+
+    def lease(self, token):
+        '''
+        Return the next unit leased to token, or None if no units are waiting
+        '''
+        keys = [self.pending_key, self.leased_key, self.owners_key, self.attempts_key, self.failed_key]
+        value = self.lease_script(keys=keys, args=[token, self.lease_timeout, self.max_attempts])
+        return None if value is None else self.decode(value)
+
+    def extend(self, unit, token):
+        keys = [self.leased_key, self.owners_key]
+        return bool(self.extend_script(keys=keys, args=[self.encode(unit), token, self.lease_timeout]))
+
+    def ack(self, unit, token, records, new_units=()):
+        '''
+        Finish unit, saving its records and queueing new_units. Returns
+        False if the lease had expired and the unit was given to another
+        worker, in which case nothing is saved.
+        '''
+        keys = [self.leased_key, self.owners_key, self.attempts_key, self.pending_key, self.results_key]
+        result = json.dumps({'unit': unit, 'records': records}, default=json_default)
+        args = [self.encode(unit), token, result] + [self.encode(u) for u in new_units]
+        return bool(self.ack_script(keys=keys, args=args))
+
+    def release(self, unit, token):
+        keys = [self.leased_key, self.owners_key, self.pending_key]
+        return bool(self.release_script(keys=keys, args=[self.encode(unit), token]))
+
+    def pop_result(self, timeout=1):
+        '''
+        Return the next acked (unit, records, receipt), or None if there
+        isn't one within timeout seconds. The result is kept until it's
+        passed to remove_result() with its receipt.
+        '''
+        item = self.client.brpoplpush(self.results_key, self.processing_key, timeout=timeout)
+        if item is None:
+            return None
+
+        result = json.loads(item)
+        return result['unit'], result['records'], item
+
+    def remove_result(self, receipt):
+        '''
+        Delete a result popped by pop_result() once its records are saved
+        '''
+        self.client.lrem(self.processing_key, 1, receipt)
+
+    def requeue_results(self):
+        '''
+        Put back the results popped by a coordinator that died before
+        saving them, returning how many there were
+        '''
+        count = 0
+        while self.client.rpoplpush(self.processing_key, self.results_key) is not None:
+            count += 1
+        return count
+
+    def counts(self):
+        '''
+        Return the number of pending, leased and unread results as of a
+        single point in time
+        '''
+        pipe = self.client.pipeline(transaction=True)
+        pipe.llen(self.pending_key)
+        pipe.zcard(self.leased_key)
+        pipe.llen(self.results_key)
+        return tuple(pipe.execute())
+
+    def failed(self):
+        return [self.decode(v) for v in self.client.smembers(self.failed_key)]
+
+class Heartbeat(threading.Thread):
+    """ Renews a lease every third of the lease timeout until stopped.
+    """
+    def __init__(self, queue, unit, token):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.unit = unit
+        self.token = token
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.queue.lease_timeout / 3):
+            if not self.queue.extend(self.unit, self.token):
+                logger.warning(f'Lost the lease on {self.unit}')
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def coordinate(scraper, queue, sink, reset=False, poll_interval=1):
+    '''
+    Queue scraper's work units and write the records workers send back to
+    sink until every unit is finished. If the queue is already running
+    (say, the last coordinator died) it's picked up where it was, in which
+    case sink should append to the last coordinator's output.
+    '''
+    if reset or queue.state() != 'running':
+        queue.start(scraper.get_work_units())
+        logger.info(f'Queued {queue.counts()[0]} units for {queue.name}')
+    else:
+        requeued = queue.requeue_results()
+        logger.info(f'Picking up the running queue for {queue.name}, {requeued} results to rewrite')
+
+    units = 0
+    last_report = time.monotonic()
+
+    while True:
+        result = queue.pop_result(timeout=poll_interval)
+        if result is not None:
+            unit, records, receipt = result
+            sink.write_many(Home.from_dict(r) for r in records)
+            sink.after_flush(partial(queue.remove_result, receipt))
+            units += 1
+            continue
+
+        pending, leased, results = queue.counts()
+        if pending == 0 and leased == 0 and results == 0:
+            break
+
+        if time.monotonic() - last_report >= 30:
+            logger.info(f'{units} units done, {pending} pending, {leased} leased')
+            last_report = time.monotonic()
+
+    failed = queue.failed()
+    if failed:
+        logger.warning(f'Gave up on {len(failed)} units: {failed}')
+
+    # Every result has to be saved before the queue is cleared
+    sink.flush()
+    queue.finish()
+
+    logger.info(f'Finished {units} units, wrote {sink.count} records')
+    return sink.count
+
+def work(scraper, queue, poll_interval=1):
+    '''
+    Lease units from queue and scrape them with scraper until the queue
+    is finished. Returns the number of units done.
+    '''
+    token = uuid.uuid4().hex
+    done = 0
+
+    while True:
+        state = queue.state()
+        if state == 'finished':
+            break
+
+        unit = queue.lease(token) if state == 'running' else None
+        if unit is None:
+            pending, leased, _ = queue.counts()
+            if state == 'running' and pending == 0 and leased == 0:
+                break
+
+            time.sleep(poll_interval)
+            continue
+
+        heartbeat = Heartbeat(queue, unit, token)
+        heartbeat.start()
+
+        try:
+            # The scraper may update the unit in place, e.g. Ryan Homes' homes
+            records, new_units = scraper.process_work_unit(copy.deepcopy(unit))
+        except Exception as e:
+            logger.warning(f'Failed on {unit}: {e}')
+            heartbeat.stop()
+            queue.release(unit, token)
+            continue
+
+        heartbeat.stop()
+
+        if queue.ack(unit, token, records, new_units):
+            done += 1
+        else:
+            logger.warning(f'Lease on {unit} expired, dropping its {len(records)} records')
+
+    return done
+
+if __name__ == '__main__':
+    from runner import SCRAPERS, make_scraper
+    from sinks import make_sink
+    from metrics import export_metrics
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('role', choices=['coordinate', 'work'])
+    parser.add_argument('scraper', choices=[n for n in SCRAPERS if n != 'lennar'])
+    parser.add_argument('--redis-url', default=os.environ.get('WORKQUEUE_REDIS_URL', 'redis://localhost:6379/0'),
+                        help='Redis server holding the queue')
+    parser.add_argument('--output',
+                        help='output file written by the coordinator (default: the scraper\'s)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='units worked on at once by this process')
+    parser.add_argument('--lease-timeout', type=float, default=300,
+                        help='seconds before a dead worker\'s units are given to another')
+    parser.add_argument('--reset', action='store_true',
+                        help='start over instead of picking up a running queue')
+    parser.add_argument('--base-url',
+                        help='site to scrape, e.g. a local mockserver.py')
+    args = parser.parse_args()
+
+    FORMAT = "%(asctime)s [ %(filename)s:%(lineno)s - %(funcName)s() ] %(message)s"
+    logging.basicConfig(format=FORMAT, datefmt='%Y-%m-%d %H:%M:%S')
+    logger.setLevel(logging.DEBUG)
+
+    export_metrics()
+
+    scraper = make_scraper(args.scraper, base_url=args.base_url)
+    queue = WorkQueue(StrictRedis.from_url(args.redis_url), args.scraper,
+                      lease_timeout=args.lease_timeout)
+
+    if args.role == 'coordinate':
+        append = not args.reset and queue.state() == 'running'
+
+        with make_sink(args.output or scraper.output, scraper.fields, append=append,
+                       builder=scraper.builder) as sink:
+            coordinate(scraper, queue, sink, reset=args.reset)
+    else:
+        threads = [
+            threading.Thread(target=work, args=(scraper, queue)) for _ in range(args.workers)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()